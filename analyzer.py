@@ -0,0 +1,135 @@
+from decoder import decode, InstructionTable, OP_SET, OP_FILL, OP_SLEEP, OP_SHOW, OP_SECTION, OP_REPEAT, \
+    OP_MOVE_UP, OP_MOVE_DOWN, OP_SET_MULTIPLE, OP_SET_BRIGHTNESS, OP_DEFINE, OP_CALL, OP_RETURN, OP_END_SECTION
+
+WRITES = (OP_SET, OP_FILL, OP_SET_MULTIPLE, OP_SET_BRIGHTNESS)
+
+
+# What a program does when played to the end: seconds spent sleeping, SHOWs executed, frames and
+# instructions executed. Duration, shows and instructions are exact. Frames is an upper bound: it counts the
+# SHOWs with pixel writes since the previous one, whether or not the writes changed a pixel
+class Analysis:
+    def __init__(self, duration=0.0, shows=0, frames=0, instructions=0):
+        self.duration = duration
+        self.shows = shows
+        self.frames = frames
+        self.instructions = instructions
+
+    def add(self, other, times=1):
+        self.duration += other.duration * times
+        self.shows += other.shows * times
+        self.frames += other.frames * times
+        self.instructions += other.instructions * times
+
+    def to_dict(self):
+        return {
+            'duration': self.duration,
+            'shows': self.shows,
+            'frames': self.frames,
+            'instructions': self.instructions,
+        }
+
+    def __repr__(self):
+        return f'Analysis({self.duration:.3f}s, {self.shows} shows, {self.frames} frames, ' \
+               f'{self.instructions} instructions)'
+
+
+# Walks the decoded program once per distinct (section, dirty) state instead of executing it. Only the
+# first iteration of a REPEAT and the ones after it can differ, by whether the strip is in sync on entry.
+# Pixel values are not tracked, so a MOVE with the show flag always makes a frame and the iterations after
+# the first start dirty whenever the body writes, even when it puts back what was shown.
+# SLEEP operands already include the speed multiplier they were compiled with, so SET_SPEED and
+# RESET_SPEED do not change the duration
+class _Analyzer:
+    def __init__(self, table):
+        self.table = table
+        self.sections = {}
+        self.calls = {}
+
+    def block(self, row, dirty):
+        table = self.table
+        ops, arg_a, arg_c = table.ops, table.a, table.c
+        result = Analysis()
+        writes = False
+        end = len(ops)
+        while row < end:
+            op = ops[row]
+            if op == OP_REPEAT or op == OP_RETURN:
+                break
+            result.instructions += 1
+            if op in WRITES:
+                writes = dirty = True
+            elif op == OP_SHOW:
+                result.shows += 1
+                if dirty:
+                    result.frames += 1
+                    dirty = False
+            elif op == OP_SLEEP:
+                result.duration += arg_a[row] / 1000
+            elif op == OP_MOVE_UP or op == OP_MOVE_DOWN:
+                writes = dirty = True
+                if arg_c[row] & 1:
+                    result.shows += 1
+                    result.frames += 1
+                    dirty = False
+            elif op == OP_SECTION:
+                sub, dirty, sub_writes, row = self.section(row, dirty)
+                result.add(sub)
+                writes = writes or sub_writes
+                continue
+            elif op == OP_DEFINE:
+                row = table.b[row]
+                continue
+            elif op == OP_CALL:
+                sub, dirty, sub_writes = self.call(arg_a[row], dirty)
+                result.add(sub)
+                writes = writes or sub_writes
+            elif op == OP_END_SECTION:
+                raise ValueError(f"Unexpected END_SECTION at instruction {row}")
+            row += 1
+        return result, dirty, writes, row
+
+    def section(self, row, dirty):
+        key = (row, dirty)
+        cached = self.sections.get(key)
+        if cached is not None:
+            return cached
+        ops = self.table.ops
+        first, exit_dirty, writes, end = self.block(row + 1, dirty)
+        # The SECTION row itself is counted by the enclosing block
+        result = Analysis()
+        result.add(first)
+        if end < len(ops) and ops[end] == OP_REPEAT:
+            times = self.table.a[end]
+            result.instructions += times + 1
+            if times > 1:
+                rest, exit_dirty, _, _ = self.block(row + 1, exit_dirty or writes)
+                result.add(rest, times - 1)
+            end += 2
+        cached = self.sections[key] = (result, exit_dirty, writes, end)
+        return cached
+
+    def call(self, entry, dirty):
+        key = (entry, dirty)
+        cached = self.calls.get(key)
+        if cached is not None:
+            return cached
+        result, dirty, writes, end = self.block(entry, dirty)
+        if end >= len(self.table.ops) or self.table.ops[end] != OP_RETURN:
+            raise ValueError(f"Subroutine at instruction {entry} does not end with RETURN")
+        result.instructions += 1
+        cached = self.calls[key] = (result, dirty, writes)
+        return cached
+
+
+def analyze_table(table):
+    result, _, _, end = _Analyzer(table).block(0, True)
+    if end < len(table.ops):
+        raise ValueError(f"Unmatched {'REPEAT' if table.ops[end] == OP_REPEAT else 'RETURN'} at instruction {end}")
+    return result
+
+
+# Same decoded form as NeoPixelInterpretor.build_cmd_q, including its leading SECTION
+def analyze(data):
+    table = InstructionTable()
+    table.append(OP_SECTION)
+    return analyze_table(decode(data, table))
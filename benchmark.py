@@ -0,0 +1,249 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import colors
+import leds_file
+from interpretor import NeoPixelInterpretor
+from metrics import Metrics
+from neopixel2 import Neopixel
+from outputs import NullOutput
+from pixel_state import np
+from timeline import VirtualClock
+
+SIZES = (100, 500, 2000)
+STRIP_MODES = ('thread', 'process')
+
+
+def nested_repeat(pixels, num_px):
+    def level(depth):
+        with pixels.section_repeat(3):
+            pixels[depth % num_px] = colors.RED
+            pixels[(depth * 7) % num_px] = colors.BLUE
+            if depth:
+                level(depth - 1)
+            pixels.show(0.01)
+
+    pixels.fill(colors.BLACK)
+    level(6)
+
+
+def scroller(pixels, num_px):
+    pixels.set_gradient([colors.RED, colors.GREEN, colors.BLUE, colors.VIOLET], 0, num_px - 1)
+    with pixels.section_repeat(5):
+        for _ in range(40):
+            pixels.move_up(1, 0, num_px - 1, rotate=True)
+            pixels.move_down(2, num_px // 4, num_px - 1, trail=True)
+            pixels.show(0.02)
+
+
+def gradient_frames(pixels, num_px):
+    palette = [colors.RED, colors.ORANGE, colors.YELLOW, colors.GREEN, colors.CYAN, colors.BLUE, colors.INDIGO]
+    for frame in range(100):
+        shifted = palette[frame % len(palette):] + palette[:frame % len(palette)]
+        pixels.set_gradient(shifted[:3], 0, num_px - 1)
+        pixels.show(0.03)
+
+
+def set_chain(pixels, num_px):
+    for frame in range(100):
+        for i in range(50):
+            pixels[(frame + i * 5) % num_px] = colors.CYAN if i % 2 else colors.ORANGE + (frame % 100,)
+        pixels.show(0.01)
+
+
+WORKLOADS = {
+    'nested_repeat': nested_repeat,
+    'scroller': scroller,
+    'gradient_frames': gradient_frames,
+    'set_chain': set_chain,
+}
+
+
+def compile_workload(workload, num_px, directory):
+    path = os.path.join(directory, f'{workload.__name__}-{num_px}.leds')
+    pixels = Neopixel(num_px, path)
+    workload(pixels, num_px)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pixels.save()
+    return leds_file.load(path)[1]
+
+
+def make_interpretor(num_px, engine, metrics=None):
+    clock = VirtualClock()
+    return NeoPixelInterpretor(
+        NullOutput(num_px), num_px, runtime=float('inf'), clock=clock.time, sleep=clock.sleep,
+        engine=engine, metrics=metrics
+    )
+
+
+# Wall time from the call to run to the first frame, the run is stopped right after it
+def first_frame(data, num_px, engine, stream):
+    interpretor = make_interpretor(num_px, engine)
+    interpretor.interrupted = lambda: interpretor.first_frame is not None
+    interpretor.run(data, stream=stream)
+    return interpretor.first_frame
+
+
+def measure(data, num_px, engine, repeat):
+    interpretor = make_interpretor(num_px, engine)
+    decode_time = min(_timed(interpretor.build_cmd_q, data) for _ in range(repeat))
+    run_time = min(_timed(make_interpretor(num_px, engine).run, data) for _ in range(repeat))
+    stream_run_time = min(
+        _timed(lambda: make_interpretor(num_px, engine).run(data, stream=True)) for _ in range(repeat)
+    )
+    first_frames = {
+        stream: min(first_frame(data, num_px, engine, stream) or 0.0 for _ in range(repeat))
+        for stream in (False, True)
+    }
+
+    # Counting and memory tracing slow the interpreter down, so they get their own run
+    metrics = Metrics()
+    interpretor = make_interpretor(num_px, engine, metrics)
+    tracemalloc.start()
+    interpretor.run(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    instructions = sum(metrics.op_counts)
+    frames = interpretor.state.shows + interpretor.state.shows_skipped
+    return {
+        'bytes': len(data),
+        'decode_seconds': decode_time,
+        'run_seconds': run_time,
+        'stream_run_seconds': stream_run_time,
+        'first_frame_seconds': first_frames[False],
+        'stream_first_frame_seconds': first_frames[True],
+        'instructions': instructions,
+        'frames': frames,
+        'instructions_per_second': instructions / run_time if run_time else 0.0,
+        'frames_per_second': frames / run_time if run_time else 0.0,
+        'peak_memory_bytes': peak,
+    }
+
+
+def play_strip(data, num_px, engine):
+    interpretor = make_interpretor(num_px, engine)
+    interpretor.run(data)
+    return interpretor.state.shows + interpretor.state.shows_skipped
+
+
+# Plays data on count strips at once, one interpreter per strip like the server, and returns the frames per
+# second of all the strips together. The first round starts the workers and is not timed
+def measure_strips(data, num_px, engine, count, mode, repeat):
+    executor = ThreadPoolExecutor if mode == 'thread' else ProcessPoolExecutor
+    args = ([data] * count, [num_px] * count, [engine] * count)
+    with executor(max_workers=count) as pool:
+        frames = sum(pool.map(play_strip, *args))
+        run_time = min(_timed(lambda: list(pool.map(play_strip, *args))) for _ in range(repeat))
+    return {
+        'strips': count,
+        'mode': mode,
+        'frames': frames,
+        'run_seconds': run_time,
+        'frames_per_second': frames / run_time if run_time else 0.0,
+    }
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(sizes, engines, workloads, repeat, strips=(), strip_modes=STRIP_MODES):
+    results = []
+    strip_results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for num_px in sizes:
+            for name in workloads:
+                start = time.perf_counter()
+                data = compile_workload(WORKLOADS[name], num_px, directory)
+                compile_time = time.perf_counter() - start
+                for engine in engines:
+                    result = {'workload': name, 'num_px': num_px, 'engine': engine, 'compile_seconds': compile_time}
+                    result.update(measure(data, num_px, engine, repeat))
+                    results.append(result)
+                    print(
+                        f"{name:16} {num_px:5}px {engine:6} "
+                        f"{result['instructions_per_second']:12.0f} instr/s "
+                        f"{result['frames_per_second']:10.0f} frames/s "
+                        f"compile {compile_time * 1000:8.2f} ms "
+                        f"decode {result['decode_seconds'] * 1000:8.2f} ms "
+                        f"first frame {result['first_frame_seconds'] * 1000:7.2f} ms "
+                        f"(stream {result['stream_first_frame_seconds'] * 1000:7.2f} ms) "
+                        f"peak {result['peak_memory_bytes'] / 1024:9.1f} KiB"
+                    )
+                    for mode in strip_modes:
+                        for count in strips:
+                            result = {'workload': name, 'num_px': num_px, 'engine': engine}
+                            result.update(measure_strips(data, num_px, engine, count, mode, repeat))
+                            strip_results.append(result)
+                            print(
+                                f"{name:16} {num_px:5}px {engine:6} {count:3} strips ({mode:7}) "
+                                f"{result['frames_per_second']:10.0f} frames/s total"
+                            )
+    return {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+        'strips': strip_results,
+    }
+
+
+def compare(report, baseline):
+    previous = {(r['workload'], r['num_px'], r['engine']): r for r in baseline['results']}
+    print(f"Compared to {baseline.get('revision') or 'baseline'}:")
+    for result in report['results']:
+        old = previous.get((result['workload'], result['num_px'], result['engine']))
+        if not old or not old['instructions_per_second']:
+            continue
+        change = result['instructions_per_second'] / old['instructions_per_second'] - 1
+        print(f"{result['workload']:16} {result['num_px']:5}px {result['engine']:6} {change * 100:+7.1f}% instr/s")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Interpreter throughput benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--engines', nargs='+', default=['list', 'numpy'] if np is not None else ['list'])
+    parser.add_argument('--workloads', nargs='+', default=list(WORKLOADS), choices=list(WORKLOADS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--strips', type=int, nargs='+', default=[],
+                        help='strip counts to measure the aggregate frames/s of, e.g. 1 2 4')
+    parser.add_argument('--strip-modes', nargs='+', default=list(STRIP_MODES), choices=list(STRIP_MODES))
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    args = parser.parse_args(argv)
+
+    report = run(args.sizes, args.engines, args.workloads, args.repeat, args.strips, args.strip_modes)
+    with open(args.output, 'w') as fd:
+        json.dump(report, fd, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, 'r') as fd:
+            compare(report, json.load(fd))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,70 @@
+import json
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CACHE_LIMIT = 4096
+
+
+class ColorPipeline:
+    def __init__(self, exponent=1.25, gamma=None, calibration=(1.0, 1.0, 1.0)):
+        self.exponent = exponent
+        self.gamma = gamma
+        self.calibration = tuple(calibration)
+        # Brightness byte -> multiplier. Levels 0..100 are the curve, higher bytes extrapolate it
+        self.levels = [int(((o / 100) ** exponent) * 255) for o in range(256)]
+        self.channels = [
+            [self._channel_value(c, calibration[channel]) for c in range(256)]
+            for channel in range(3)
+        ]
+        self.cache = {}
+        if np is not None:
+            self.np_levels = np.array(self.levels, dtype=np.float64)
+            self.np_channels = np.array(self.channels, dtype=np.float64)
+            self.np_channel_index = np.arange(3)
+
+    def _channel_value(self, c, calibration):
+        if self.gamma is not None:
+            c = 255 * (c / 255) ** self.gamma
+        if calibration != 1:
+            c = c * calibration
+        return c
+
+    def signature(self):
+        return f'{self.exponent}:{self.gamma}:{self.calibration}'
+
+    def brightness(self, o):
+        return self.levels[o]
+
+    def c2p(self, color):
+        px = self.cache.get(color)
+        if px is None:
+            level = self.levels[color[3]]
+            channels = self.channels
+            px = (
+                channels[0][color[0]] * level / 255,
+                channels[1][color[1]] * level / 255,
+                channels[2][color[2]] * level / 255,
+            )
+            if len(self.cache) >= CACHE_LIMIT:
+                self.cache.clear()
+            self.cache[color] = px
+        return px
+
+    def convert(self, colors):
+        return self.np_channels[self.np_channel_index, colors[:, :3]] * self.np_levels[colors[:, 3]][:, None] / 255
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.isfile(path):
+            return cls()
+        with open(path, 'r') as fd:
+            conf = json.load(fd)
+        return cls(
+            exponent=conf.get('exponent', 1.25),
+            gamma=conf.get('gamma'),
+            calibration=conf.get('calibration', (1.0, 1.0, 1.0)),
+        )
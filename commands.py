@@ -0,0 +1,77 @@
+import threading
+from collections import deque
+from enum import Enum
+
+
+class Command(Enum):
+    PLAY_TEST = 'play_test'
+    PAUSE = 'pause'
+    RESUME = 'resume'
+    REFRESH = 'refresh'
+    SKIP = 'skip'
+    SHUTDOWN = 'shutdown'
+
+
+# Commands that stop the animation currently playing
+INTERRUPTING = (Command.PLAY_TEST, Command.PAUSE, Command.SKIP, Command.SHUTDOWN)
+
+
+# Queue of (command, payload) from the Site and signal handlers to the Controller. The Controller blocks
+# in receive() while paused and the interpreter polls interrupting() between instructions, so a command
+# takes effect without any polling loop on the Controller side. on_interrupt is called for every
+# interrupting command, to wake up a sleeping interpreter
+class CommandChannel:
+    def __init__(self, on_interrupt=None):
+        self.on_interrupt = on_interrupt
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.interrupts = 0
+        # Name of the user whose test animation is queued or playing
+        self.tester = None
+
+    def send(self, command, payload=None):
+        with self.cond:
+            self.queue.append((command, payload))
+            if command in INTERRUPTING:
+                self.interrupts += 1
+            self.cond.notify_all()
+        if command in INTERRUPTING and self.on_interrupt is not None:
+            self.on_interrupt()
+
+    def _pop(self):
+        command, payload = self.queue.popleft()
+        if command in INTERRUPTING:
+            self.interrupts -= 1
+        return command, payload
+
+    def receive(self, timeout=None):
+        with self.cond:
+            if not self.queue and not self.cond.wait_for(lambda: self.queue, timeout):
+                return None, None
+            return self._pop()
+
+    def poll(self):
+        with self.cond:
+            if not self.queue:
+                return None, None
+            return self._pop()
+
+    def interrupting(self):
+        return self.interrupts > 0
+
+    def testing(self):
+        with self.cond:
+            return self.tester
+
+    # Queues a test unless one is already queued or playing, in which case its user is returned
+    def start_test(self, username, filename):
+        with self.cond:
+            if self.tester is not None:
+                return self.tester
+            self.tester = username
+        self.send(Command.PLAY_TEST, (username, filename))
+        return None
+
+    def finish_test(self):
+        with self.cond:
+            self.tester = None
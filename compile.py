@@ -1,15 +1,25 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
 import os
 import sys
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from importlib import import_module
 
 from neopixel2 import Neopixel
 
 NUM_PX = 100
+PROGRAMS_DIR = "programs"
+# Source hash, helpers hash, pixel count, compiler version and summary of every program compiled by --all
+MANIFEST = os.path.join(PROGRAMS_DIR, ".manifest.json")
 
 
 def main(filename, verbose=False):
-    filepath = os.path.join("programs", f"{filename}.leds")
+    filepath = os.path.join(PROGRAMS_DIR, f"{filename}.leds")
     pixels = Neopixel(NUM_PX, filepath, verbose)
     found_module = False
 
@@ -26,7 +36,148 @@ def main(filename, verbose=False):
             pixels.save()
 
 
-if len(sys.argv) < 2:
-    print(f"Usage python3 {sys.argv[0]} <module> [-v]")
-else:
-    main(*sys.argv[1:])
+def _hash_file(path):
+    with open(path, 'rb') as fd:
+        return hashlib.sha256(fd.read()).hexdigest()
+
+
+# Modules of this directory that compile a program or that programs import, any change to one of them
+# recompiles everything. colors is only imported by the programs, so it can't be found from sys.modules
+COMPILER_MODULES = [
+    'analyzer', 'color_pipeline', 'colors', 'compile', 'decoder', 'interpretor', 'leds_file', 'neopixel2',
+    'opcodes', 'optimizer', 'pixel_state', 'scheduler', 'subroutines',
+]
+
+
+def compiler_version():
+    root = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in COMPILER_MODULES:
+        digest.update(name.encode())
+        digest.update(_hash_file(os.path.join(root, f"{name}.py")).encode())
+    return digest.hexdigest()[:16]
+
+
+# Modules starting with an underscore are helpers shared by the programs, not programs
+def program_names():
+    return sorted(
+        name[:-3] for name in os.listdir(PROGRAMS_DIR)
+        if name.endswith('.py') and not name.startswith('_')
+    )
+
+
+# Hash of every helper module of programs/, a change to any of them recompiles every program since any
+# program may import it
+def helpers_version():
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(PROGRAMS_DIR)):
+        if name.endswith('.py') and name.startswith('_'):
+            digest.update(name.encode())
+            digest.update(_hash_file(os.path.join(PROGRAMS_DIR, name)).encode())
+    return digest.hexdigest()[:16]
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST, 'r') as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest):
+    tmp = f'{MANIFEST}.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(manifest, fd, indent=2, sort_keys=True)
+    os.replace(tmp, MANIFEST)
+
+
+# Runs in a worker process. Returns the summary of the program, or its error
+def compile_program(name, num_px):
+    filepath = os.path.join(PROGRAMS_DIR, f"{name}.leds")
+    start = time.perf_counter()
+    pixels = Neopixel(num_px, filepath)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import_module(f"programs.{name}").main(pixels)
+            analysis = pixels.save()
+    except Exception as e:
+        pixels.fd.close()
+        os.remove(filepath)
+        return {'error': f'{type(e).__name__}: {e}'}
+    return {
+        'duration': analysis.duration,
+        'frames': analysis.frames,
+        'bytes': os.path.getsize(filepath),
+        'warnings': sorted(pixels.warnings),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def _summary_line(name, summary, state):
+    if 'error' in summary:
+        return f"{name:24} {'FAILED':10} {summary['error']}"
+    warnings = '; '.join(summary['warnings'])
+    return f"{name:24} {state:10} {summary['duration']:8.1f} s {summary['frames']:7} frames " \
+           f"{summary['bytes']:9} bytes  {warnings}"
+
+
+# Compiles every program of programs/ whose source, helpers, pixel count or compiler changed since the
+# manifest was written, on a pool of jobs processes
+def compile_all(num_px=NUM_PX, jobs=None, force=False):
+    start = time.perf_counter()
+    version = compiler_version()
+    helpers = helpers_version()
+    manifest = load_manifest()
+    names = program_names()
+    sources = {name: _hash_file(os.path.join(PROGRAMS_DIR, f"{name}.py")) for name in names}
+    stale = [
+        name for name in names
+        if force or manifest.get(name, {}).get('source') != sources[name]
+        or manifest[name].get('helpers') != helpers or manifest[name].get('num_px') != num_px
+        or manifest[name].get('compiler') != version
+        or not os.path.isfile(os.path.join(PROGRAMS_DIR, f"{name}.leds"))
+    ]
+
+    results = {}
+    if stale:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = dict(zip(stale, pool.map(compile_program, stale, [num_px] * len(stale))))
+
+    updated = {name: entry for name, entry in manifest.items() if name in sources}
+    failed = 0
+    for name in names:
+        if name in results:
+            summary = results[name]
+            if 'error' in summary:
+                failed += 1
+                updated.pop(name, None)
+            else:
+                updated[name] = {
+                    'source': sources[name], 'helpers': helpers, 'num_px': num_px, 'compiler': version,
+                    'summary': summary,
+                }
+            print(_summary_line(name, summary, 'compiled'))
+        else:
+            print(_summary_line(name, updated[name]['summary'], 'up to date'))
+    save_manifest(updated)
+    print(f"{len(results) - failed} compiled, {failed} failed, {len(names) - len(results)} up to date "
+          f"in {time.perf_counter() - start:.1f} s")
+    return failed == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compiles animation programs from programs/ to .leds files')
+    parser.add_argument('module', nargs='?', help='program module to compile')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--all', action='store_true', help='compile every program that changed')
+    parser.add_argument('--force', action='store_true', help='with --all, compile up to date programs too')
+    parser.add_argument('--jobs', '-j', type=int, help='worker processes for --all, one per CPU by default')
+    parser.add_argument('--num-px', type=int, default=NUM_PX, help='pixel count for --all')
+    args = parser.parse_args()
+    if args.all:
+        sys.exit(0 if compile_all(args.num_px, args.jobs, args.force) else 1)
+    elif args.module is None:
+        parser.print_usage()
+    else:
+        main(args.module, args.verbose)
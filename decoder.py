@@ -0,0 +1,319 @@
+import struct
+from array import array
+
+from opcodes import Opcodes
+
+_U16 = struct.Struct('>H')
+_COLOR = struct.Struct('>I')
+_SET = struct.Struct('>BI')
+_MOVE = struct.Struct('>BBBB')
+_BRIGHTNESS = struct.Struct('>BB')
+_SET_WIDE = struct.Struct('>HI')
+_MOVE_WIDE = struct.Struct('>HHHB')
+_BRIGHTNESS_WIDE = struct.Struct('>HB')
+
+# Enum attribute lookups are slow, the decode loop compares against plain ints
+OP_SET = Opcodes.SET.value
+OP_FILL = Opcodes.FILL.value
+OP_SLEEP = Opcodes.SLEEP.value
+OP_SHOW = Opcodes.SHOW.value
+OP_SHOW_AND_SLEEP = Opcodes.SHOW_AND_SLEEP.value
+OP_SECTION = Opcodes.SECTION.value
+OP_REPEAT = Opcodes.REPEAT.value
+OP_MOVE_UP = Opcodes.MOVE_UP.value
+OP_MOVE_DOWN = Opcodes.MOVE_DOWN.value
+OP_SET_SPEED = Opcodes.SET_SPEED.value
+OP_RESET_SPEED = Opcodes.RESET_SPEED.value
+OP_SET_MULTIPLE = Opcodes.SET_MULTIPLE.value
+OP_SET_BRIGHTNESS = Opcodes.SET_BRIGHTNESS.value
+OP_DEFINE = Opcodes.DEFINE.value
+OP_CALL = Opcodes.CALL.value
+OP_RETURN = Opcodes.RETURN.value
+OP_SET_WIDE = Opcodes.SET_WIDE.value
+OP_SET_MULTIPLE_WIDE = Opcodes.SET_MULTIPLE_WIDE.value
+OP_MOVE_UP_WIDE = Opcodes.MOVE_UP_WIDE.value
+OP_MOVE_DOWN_WIDE = Opcodes.MOVE_DOWN_WIDE.value
+OP_SET_BRIGHTNESS_WIDE = Opcodes.SET_BRIGHTNESS_WIDE.value
+OP_END_SECTION = Opcodes.END_SECTION.value
+
+
+# Encoded size of each fixed-size instruction, SET_MULTIPLE is 2 bytes plus 5 per entry and
+# SET_MULTIPLE_WIDE 3 bytes plus 6 per entry
+SIZES = {
+    OP_SET: 6, OP_FILL: 5, OP_SLEEP: 3, OP_SHOW: 1, OP_SHOW_AND_SLEEP: 3, OP_SECTION: 1, OP_REPEAT: 3,
+    OP_MOVE_UP: 5, OP_MOVE_DOWN: 5, OP_SET_SPEED: 3, OP_RESET_SPEED: 1, OP_SET_BRIGHTNESS: 3,
+    OP_DEFINE: 3, OP_CALL: 3, OP_RETURN: 1, OP_END_SECTION: 1,
+    OP_SET_WIDE: 7, OP_MOVE_UP_WIDE: 8, OP_MOVE_DOWN_WIDE: 8, OP_SET_BRIGHTNESS_WIDE: 4,
+}
+
+# Wide opcodes decode to the rows of their 8-bit counterparts
+NARROW = {
+    OP_SET_WIDE: OP_SET, OP_SET_MULTIPLE_WIDE: OP_SET_MULTIPLE, OP_MOVE_UP_WIDE: OP_MOVE_UP,
+    OP_MOVE_DOWN_WIDE: OP_MOVE_DOWN, OP_SET_BRIGHTNESS_WIDE: OP_SET_BRIGHTNESS,
+}
+
+# Program bytes decoded at a time by a StreamTable
+STREAM_WINDOW = 16 * 1024
+
+
+def unpack_color(packed):
+    return packed >> 24, (packed >> 16) & 0xff, (packed >> 8) & 0xff, packed & 0xff
+
+
+# One row per instruction in the parallel ops/a/b/c arrays. Colors are interned and referenced by id,
+# SET_MULTIPLE payloads live in the multi_index/multi_color side tables (a = offset, b = count).
+# A table holding one chunk of a longer program has a following() callable that decodes the next chunk
+# and returns its table, or None after the last one. The first shared rows of the following tables are the
+# subroutine definitions again, copied in front of every chunk
+class InstructionTable:
+    def __init__(self):
+        self.ops = array('B')
+        self.a = array('I')
+        self.b = array('I')
+        self.c = array('I')
+        self.colors = []
+        self.color_ids = {}
+        self.multi_index = array('H')
+        self.multi_color = array('I')
+        # Entry row of every subroutine defined so far, by id
+        self.routines = {}
+        self.following = None
+        self.shared = 0
+
+    def __len__(self):
+        return len(self.ops)
+
+    def append(self, op, a=0, b=0, c=0):
+        self.ops.append(op)
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+
+    def color_id(self, packed):
+        cid = self.color_ids.get(packed)
+        if cid is None:
+            cid = len(self.colors)
+            self.color_ids[packed] = cid
+            self.colors.append(unpack_color(packed))
+        return cid
+
+    def copy(self):
+        table = InstructionTable()
+        table.ops, table.a, table.b, table.c = array('B', self.ops), array('I', self.a), array('I', self.b), \
+            array('I', self.c)
+        table.colors = self.colors.copy()
+        table.color_ids = self.color_ids.copy()
+        table.multi_index = array('H', self.multi_index)
+        table.multi_color = array('I', self.multi_color)
+        table.routines = self.routines.copy()
+        return table
+
+    def nbytes(self):
+        arrays = (self.ops, self.a, self.b, self.c, self.multi_index, self.multi_color)
+        return sum(len(arr) * arr.itemsize for arr in arrays) + len(self.colors) * 4
+
+    # Jump targets (section starts, return points, subroutine entries) as the interpreter keeps them. They
+    # are rows here and byte offsets in a StreamTable
+    def position(self, row):
+        return row
+
+    def seek(self, position):
+        return position
+
+
+# Table decoded a window of about window bytes at a time while it is played, so playback starts after the
+# first window instead of after the whole program. Jump targets are byte offsets: a jump back out of the
+# window decodes a new window from the target, and the window is refilled in place so the interpreter keeps
+# its references to the arrays. The first window starts with the prefix rows
+class StreamTable(InstructionTable):
+    def __init__(self, data, window=STREAM_WINDOW, prefix=()):
+        super().__init__()
+        self.data = memoryview(data)
+        self.window = window
+        # Byte offset of the first instruction after the window
+        self.stop = 0
+        # Rows of the jump targets in the window by byte offset, and the other way around
+        self.targets = {}
+        self.positions = {}
+        self.following = self._next
+        self._fill(0, prefix)
+
+    def _fill(self, start, prefix=()):
+        for arr in (self.ops, self.a, self.b, self.c, self.multi_index, self.multi_color):
+            del arr[:]
+        self.colors.clear()
+        self.color_ids.clear()
+        self.targets.clear()
+        self.positions.clear()
+        for op in prefix:
+            self.append(op)
+        self.mark(len(self), start)
+        self.stop = _decode(self.data, self, start, min(start + self.window, len(self.data)), self.mark)
+
+    def _next(self):
+        if self.stop >= len(self.data):
+            return None
+        self._fill(self.stop)
+        return self
+
+    def mark(self, row, offset):
+        self.targets[offset] = row
+        self.positions[row] = offset
+
+    def position(self, row):
+        return self.positions[row]
+
+    def seek(self, position):
+        row = self.targets.get(position)
+        if row is None:
+            self._fill(position)
+            row = 0
+        return row
+
+
+def scan(data):
+    mv = memoryview(data)
+    k = 0
+    end = len(mv)
+    while k < end:
+        op = mv[k]
+        if op == OP_SET_MULTIPLE:
+            size = 2 + (mv[k + 1] * _SET.size if k + 1 < end else 0)
+        elif op == OP_SET_MULTIPLE_WIDE:
+            size = 3 + (_U16.unpack_from(mv, k + 1)[0] * _SET_WIDE.size if k + 3 <= end else 0)
+        else:
+            size = SIZES.get(op)
+            if size is None:
+                raise ValueError(f"Invalid opcode in command! Got {op} at offset {k}")
+        if k + size > end:
+            raise ValueError(f"Truncated operand at offset {k}")
+        yield k, op, k + size
+        k += size
+
+
+# Subroutine bodies are decoded in place behind a DEFINE row whose b is the row after the body's RETURN,
+# CALL rows hold the entry row of the subroutine in a
+def decode(data, table=None):
+    if table is None:
+        table = InstructionTable()
+    mv = memoryview(data)
+    _decode(mv, table, 0, len(mv))
+    return table
+
+
+# Decodes the instructions starting in mv[k:end] into table and returns the offset after the last one. A
+# subroutine definition is always decoded whole. With a mark callable the rows after SECTION and CALL rows,
+# subroutine entries and REPEAT rows are marked with their byte offset, and CALL rows hold the byte offset
+# of the subroutine instead of its row
+def _decode(mv, table, k, end, mark=None):
+    append = table.append
+    color_id = table.color_id
+    routines = table.routines
+    defining = []
+    size = len(mv)
+    while True:
+        # Operands are read with unpack_from, a truncated one raises struct.error (or IndexError for the
+        # count of a SET_MULTIPLE) before k moves past its instruction
+        try:
+            while k < end:
+                op = mv[k]
+                if op == OP_SET:
+                    index, color = _SET.unpack_from(mv, k + 1)
+                    append(op, index, color_id(color))
+                    k += 6
+                elif op == OP_FILL:
+                    append(op, 0, color_id(_COLOR.unpack_from(mv, k + 1)[0]))
+                    k += 5
+                elif op == OP_SLEEP or op == OP_SET_SPEED:
+                    append(op, _U16.unpack_from(mv, k + 1)[0])
+                    k += 3
+                elif op == OP_SHOW_AND_SLEEP:
+                    append(OP_SHOW)
+                    append(OP_SLEEP, _U16.unpack_from(mv, k + 1)[0])
+                    k += 3
+                elif op == OP_REPEAT:
+                    if mark is not None:
+                        mark(len(table), k)
+                    append(op, _U16.unpack_from(mv, k + 1)[0])
+                    append(OP_END_SECTION)
+                    k += 3
+                elif op == OP_MOVE_UP or op == OP_MOVE_DOWN:
+                    lower_bound, upper_bound, spaces, flags = _MOVE.unpack_from(mv, k + 1)
+                    append(op, lower_bound, upper_bound, (spaces << 3) | flags)
+                    k += 5
+                elif op == OP_SET_MULTIPLE or op == OP_SET_MULTIPLE_WIDE:
+                    if op == OP_SET_MULTIPLE:
+                        count, start, entry = mv[k + 1], k + 2, _SET
+                    else:
+                        count, start, entry = _U16.unpack_from(mv, k + 1)[0], k + 3, _SET_WIDE
+                    offset = k
+                    k = start + count * entry.size
+                    if k > size:
+                        raise ValueError(f"Truncated operand at offset {offset}")
+                    append(OP_SET_MULTIPLE, len(table.multi_index), count)
+                    entries = list(entry.iter_unpack(mv[start:k]))
+                    table.multi_index.extend([index for index, _ in entries])
+                    table.multi_color.extend([color_id(color) for _, color in entries])
+                elif op == OP_SET_BRIGHTNESS:
+                    index, value = _BRIGHTNESS.unpack_from(mv, k + 1)
+                    append(op, index, value)
+                    k += 3
+                elif op == OP_SET_WIDE:
+                    index, color = _SET_WIDE.unpack_from(mv, k + 1)
+                    append(OP_SET, index, color_id(color))
+                    k += 7
+                elif op == OP_MOVE_UP_WIDE or op == OP_MOVE_DOWN_WIDE:
+                    lower_bound, upper_bound, spaces, flags = _MOVE_WIDE.unpack_from(mv, k + 1)
+                    append(NARROW[op], lower_bound, upper_bound, (spaces << 3) | flags)
+                    k += 8
+                elif op == OP_SET_BRIGHTNESS_WIDE:
+                    index, value = _BRIGHTNESS_WIDE.unpack_from(mv, k + 1)
+                    append(OP_SET_BRIGHTNESS, index, value)
+                    k += 4
+                elif op == OP_DEFINE:
+                    defining.append((_U16.unpack_from(mv, k + 1)[0], len(table), k + 3))
+                    append(op)
+                    k += 3
+                    if mark is not None:
+                        mark(len(table), k)
+                elif op == OP_CALL:
+                    routine = _U16.unpack_from(mv, k + 1)[0]
+                    if routine not in routines:
+                        raise ValueError(f"Call to undefined subroutine {routine} at offset {k}")
+                    append(op, routines[routine])
+                    k += 3
+                    if mark is not None:
+                        mark(len(table), k)
+                elif op == OP_RETURN:
+                    if not defining:
+                        # A window can start at the entry of a subroutine called from an earlier window
+                        if mark is None:
+                            raise ValueError(f"Return outside of a subroutine at offset {k}")
+                        append(op)
+                        k += 1
+                        continue
+                    append(op)
+                    routine, row, entry = defining.pop()
+                    table.a[row] = routine
+                    table.b[row] = len(table)
+                    routines[routine] = row + 1 if mark is None else entry
+                    k += 1
+                elif op == OP_SECTION:
+                    append(op)
+                    k += 1
+                    if mark is not None:
+                        mark(len(table), k)
+                elif op == OP_SHOW or op == OP_RESET_SPEED or op == OP_END_SECTION:
+                    append(op)
+                    k += 1
+                else:
+                    raise ValueError(f"Invalid opcode in command! Got {op} at offset {k}")
+        except (struct.error, IndexError):
+            raise ValueError(f"Truncated operand at offset {k}") from None
+        # A window never ends inside a subroutine definition
+        if not defining or k >= size:
+            break
+        end = k + 1
+    if defining:
+        raise ValueError(f"Subroutine {defining[-1][0]} is never closed")
+    return k
@@ -2,196 +2,232 @@ import math
 import threading
 import time
 
+from color_pipeline import ColorPipeline
+from decoder import decode, InstructionTable, StreamTable
 from opcodes import Opcodes
+from pixel_state import make_pixel_state
+from scheduler import DeadlineScheduler
+
+# Poll interval of the should_stop check in sleeps that cannot be interrupted (an injected sleep function)
+SLEEP_CHUNK = 1.0
 
 
 class NeoPixelInterpretor:
-    def __init__(self, pixels, num_px, test_time=40, runtime=180):
-        self.stop_check = False
+    def __init__(self, pixels, num_px, test_time=40, runtime=180, clock=None, sleep=None, engine='list',
+                 pipeline=None, max_fps=None, metrics=None, preview=None, interrupted=None, max_instructions=None):
+        # Set by stop(), every sleep of a real run waits on it so playback stops without finishing the sleep
+        self.stop_event = threading.Event()
         self.num_px = num_px
-        self.go_sem = threading.Semaphore()
         self.sect_pos = []
         self.sleep_multipliers = []
         self.state_stack = []
         self.pixels = pixels
-        self.original_color = [(0, 0, 0, 0) for _ in range(num_px)]
+        self.pipeline = pipeline or ColorPipeline()
+        self.c2p = self.pipeline.c2p
+        self.state = make_pixel_state(engine, num_px, self)
         self.test_time = test_time
         self.runtime = runtime
-        self._build_opcode_list()
         self.tabs = ''
-
-    def _build_opcode_list(self):
-        single_opcode = lambda args: ([args[0][args[1]]], args[1] + 1)
-        move_op = lambda args: ([
-                                   args[0][args[1]],
-                                   args[0][args[1] + 1],
-                                   args[0][args[1] + 2],
-                                   args[0][args[1] + 3],
-                                   args[0][args[1] + 4] >> 2,
-                                   (args[0][args[1] + 4] >> 1) & 1,
-                                   args[0][args[1] + 4] & 1
-                               ], args[1] + 5)
-        opcode_with_float = lambda args: ([
-                                             args[0][args[1]],
-                                             int.from_bytes(args[0][args[1] + 1:args[1] + 3], 'big') / 1000
-                                         ], args[1] + 3)
-        opcode_with_float_duplicate_value = lambda args: ([
-            args[0][args[1]],
-            int.from_bytes(args[0][args[1] + 1:args[1] + 3], 'big') / 1000,
-            int.from_bytes(args[0][args[1] + 1:args[1] + 3], 'big') / 1000
-        ], args[1] + 3)
-
-        self.opcodes = {
-            Opcodes.SET.value: lambda args: ([
-                                                args[0][args[1]],
-                                                int.from_bytes(args[0][args[1] + 1:args[1] + 2], 'big'),
-                                                self._bytes_to_rgb(args[0][args[1] + 2:args[1] + 6])
-                                            ], args[1] + 6),
-
-            Opcodes.FILL.value: lambda args: ([
-                                                 args[0][args[1]],
-                                                 self._bytes_to_rgb(args[0][args[1] + 1:args[1] + 5])
-                                             ], args[1] + 5),
-
-            Opcodes.SLEEP.value: opcode_with_float_duplicate_value,
-            Opcodes.SHOW.value: single_opcode,
-            Opcodes.SHOW_AND_SLEEP.value: lambda args: ([
-                [Opcodes.SHOW.value],
-                opcode_with_float_duplicate_value(args)[0],
-            ], args[1] + 3),
-            Opcodes.SECTION.value: single_opcode,
-            Opcodes.REPEAT.value: lambda args: ([
-                                                   [
-                                                       args[0][args[1]],
-                                                       int.from_bytes(args[0][args[1] + 1:args[1] + 3], 'big'),
-                                                       int.from_bytes(args[0][args[1] + 1:args[1] + 3], 'big')
-                                                   ],
-                                                   [
-                                                       Opcodes.END_SECTION.value
-                                                   ]
-                                               ], args[1] + 3),
-
-            Opcodes.MOVE_UP.value: move_op,
-            Opcodes.MOVE_DOWN.value: move_op,
-
-            Opcodes.SET_SPEED.value: opcode_with_float,
-            Opcodes.RESET_SPEED.value: single_opcode,
-
-            Opcodes.SET_MULTIPLE.value: lambda args: (
-                [
-                    args[0][args[1]],
-                    [
-                        (args[0][args[1] + buf2], self._bytes_to_rgb(args[0][args[1] + buf2 + 1:args[1] + buf2 + 5]))
-                        for buf2 in range(2, 5 * args[0][args[1] + 1] + 2, 5)
-                    ]
-                ], args[1] + args[0][args[1] + 1] * 5 + 2
-            ),
-            Opcodes.SET_BRIGHTNESS.value: lambda args: ([
-                                                           args[0][args[1]],
-                                                           args[0][args[1] + 1],
-                                                           args[0][args[1] + 2]
-                                                       ], args[1] + 3),
-            Opcodes.END_SECTION.value: single_opcode
-
-        }
-
-    def interpret_opcode(self, buffer, k=0):
-        return self.opcodes[buffer[k]]((buffer, k))
+        self.clock = clock or time.monotonic
+        self.sleep = sleep or self.stop_event.wait
+        self.scheduler = DeadlineScheduler(
+            self.clock, self.sleep, max_fps=max_fps, chunk=None if sleep is None else SLEEP_CHUNK
+        )
+        self.metrics = metrics
+        # FrameBroadcaster for the live preview, offered the state after every transmitted show
+        self.preview = preview
+        # Extra stop condition polled with stop(), such as pending Controller commands
+        self.interrupted = interrupted
+        # Instructions a real run executes at most before it ends, None for no limit
+        self.max_instructions = max_instructions
+        # How far the last real run got, see _progress
+        self.progress = None
+        # Seconds from the start of the last run to its first transmitted frame, None until then
+        self.first_frame = None
+        self.run_started = None
+
+    @property
+    def original_color(self):
+        return self.state
 
     def reset_verbose(self):
         self.tabs = ''
 
     def interpret_and_mock_run(self, buffer, verbose=False):
-        cmdlist, _ = self.interpret_opcode(buffer)
-        self.do(cmdlist if isinstance(cmdlist[0], list) else [cmdlist], mock=True, verbose=verbose)
-
-    def _bytes_to_rgb(self, byt):
-        color = int.from_bytes(byt, 'big')
-        r = color >> 24
-        g = (color >> 16) & 0xff
-        b = (color >> 8) & 0xff
-        l = color & 0xff
-        return r, g, b, l
-
-    def c2p(self, color):
-        brightness = self.compute_brightness_multiplier(color[3])
-        return tuple([
-            c * brightness / 255 for c in color[:3]
-        ])
-
-    def run(self, data, mock=False, verbose=False, test=False):
-        self.go_sem.acquire()
+        self.do(decode(buffer), mock=True, verbose=verbose)
+
+    def _reset(self, mock, verbose):
         self.sect_pos = []
         self.sleep_multipliers = []
-        self.original_color = [(0, 0, 0, 0) for _ in range(len(self.pixels))]
+        self.state_stack = []
+        self.state.reset(None if mock else self.pixels)
         if verbose:
             self.reset_verbose()
-        self.stop_check = False
-        cmdlist = self.build_cmd_q(data)
-        self.go_sem.release()
-        self.do(cmdlist, mock, verbose, test)
-
+        self.stop_event.clear()
+        self.first_frame = None
+        self.run_started = time.perf_counter()
+
+    # run, run_table and run_timeline return the progress of a real run and None for a mock run. A start_at
+    # time on the interpreter clock delays the start and makes every sleep deadline relative to it, runs on
+    # several strips given the same start_at stay in step. With stream, data is decoded a window at a time
+    # while it plays instead of whole before the first instruction
+    def run(self, data, mock=False, verbose=False, test=False, start_at=None, stream=False):
+        self._reset(mock, verbose)
+        table = self.build_stream(data) if stream else self.decode(data)
+        return self.do(table, mock, verbose, test, start_at=start_at)
+
+    # Plays a table from build_cmd_q. Tables are not modified by playing them and can be played again
+    def run_table(self, table, mock=False, verbose=False, test=False, start_at=None):
+        self._reset(mock, verbose)
+        return self.do(table, mock, verbose, test, start_at=start_at)
+
+    def run_timeline(self, timeline, start_at=None):
+        self.stop_event.clear()
+        self.first_frame = None
+        self._wait_start(start_at)
+        start_time = self.clock() if start_at is None else start_at
+        finished, shown = timeline.play(
+            self.pixels, self.should_stop, clock=self.clock, sleep=self.sleep,
+            on_frame=self.preview.offer_rgb if self.preview is not None else None, start=start_time
+        )
+        self.pixels.fill((0, 0, 0))
+        self.progress = self._progress(
+            'finished' if finished else 'stopped', start_time, min(self.clock() - start_time, timeline.duration),
+            shown, len(timeline)
+        )
+        return self.progress
+
+    def _wait_start(self, start_at):
+        if start_at is not None and start_at > self.clock() and not self.should_stop():
+            self.sleep(start_at - self.clock())
+
+    # Can be called from any thread, the current sleep returns right away
     def stop(self):
-        self.go_sem.acquire()
-        self.stop_check = True
-        self.go_sem.release()
+        self.stop_event.set()
+
+    # reason is finished, stopped, runtime, test_time or instructions. position is the program time reached in seconds,
+    # done and total count the frames or instructions played. first_frame is the wall time in seconds from
+    # the call to run or run_table to the first transmitted frame, decoding included
+    def _progress(self, reason, start_time, position, done, total):
+        return {
+            'reason': reason,
+            'elapsed': self.clock() - start_time,
+            'position': position,
+            'done': done,
+            'total': total,
+            'first_frame': self.first_frame,
+        }
+
+    def decode(self, data):
+        if self.metrics is None:
+            return self.build_cmd_q(data)
+        decode_start = time.perf_counter()
+        table = self.build_cmd_q(data)
+        self.metrics.record_decode(time.perf_counter() - decode_start)
+        return table
 
     def build_cmd_q(self, data):
-        k = 0
-        cmdlist = [[Opcodes.SECTION.value]]
-        while k < len(data):
-            cmd, k = self.interpret_opcode(data, k)
+        table = InstructionTable()
+        table.append(Opcodes.SECTION.value)
+        return decode(data, table)
 
-            if isinstance(cmd[0], list):
-                cmdlist += cmd
-            else:
-                cmdlist.append(cmd)
-        return cmdlist
+    # Same rows as build_cmd_q, decoded as they are played. A stream table is played once
+    def build_stream(self, data):
+        return StreamTable(data, prefix=(Opcodes.SECTION.value,))
 
     def should_stop(self):
-        self.go_sem.acquire()
-        val = self.stop_check
-        self.go_sem.release()
-        return val
+        return self.stop_event.is_set() or (self.interrupted is not None and self.interrupted())
 
     def _log(self, tabs, message):
         print(f'{tabs}{message}')
 
-    def compute_should_sleep(self, cmdlist, crt):
-        cmd = cmdlist[crt]
-        sleep_value = cmd[1] * self.sleep_multipliers[-1]
-        sleep_now = 0
-        if sleep_value > 0:
-            if sleep_value >= 1:
-                cmdlist[crt][1] -= self.sleep_multipliers[-1]
-                sleep_now = 1
-            else:
-                sleep_now = cmd[1]
-                cmdlist[crt][1] = cmdlist[crt][2]
-        return sleep_now
+    def _show(self, state, out):
+        self.scheduler.pace()
+        shows = state.shows
+        if self.metrics is not None:
+            show_start = time.perf_counter()
+            state.show(out)
+            if state.shows != shows:
+                self.metrics.record_show(time.perf_counter() - show_start)
+        else:
+            state.show(out)
+        if state.shows != shows:
+            self.scheduler.shown()
+            if self.first_frame is None:
+                self.first_frame = time.perf_counter() - self.run_started
+                if self.metrics is not None:
+                    self.metrics.record_first_frame(self.first_frame)
+            if self.preview is not None:
+                self.preview.offer_state(state)
 
     def compute_brightness_multiplier(self, o):
-        return int(((o / 100) ** 1.25) * 255)
-
-    def do(self, cmdlist, mock=False, verbose=False, test=False):
-        start_time = time.time()
-        crt = 0
-        while crt < len(cmdlist):
-            cmd = cmdlist[crt]
-            if cmd[0] == Opcodes.SECTION.value:
+        return self.pipeline.brightness(o)
+
+    def do(self, table, mock=False, verbose=False, test=False, start=0, start_at=None):
+        if not mock:
+            self._wait_start(start_at)
+        start_time = self.clock() if start_at is None else start_at
+        if not mock:
+            self.scheduler.start(start_time)
+        ops, arg_a, arg_b, arg_c = table.ops, table.a, table.b, table.c
+        colors = table.colors
+        state = self.state
+        out = None if mock else self.pixels
+        # Per-run repeat countdowns, keyed by the position of the REPEAT
+        remaining = {}
+        # Return positions of the subroutine calls in progress
+        calls = []
+        # Time is attributed to an instruction when the next one starts, so jumps and sleeps are included
+        metrics = None if mock else self.metrics
+        prev_op = None
+        prev_time = 0.0
+        played = 0
+        rows = len(ops) - table.shared
+        reason = 'finished'
+        crt = start
+        while True:
+            if crt >= len(ops):
+                # The table of a chunked program only holds the current chunk
+                if table.following is None:
+                    break
+                table = table.following()
+                if table is None:
+                    break
+                ops, arg_a, arg_b, arg_c = table.ops, table.a, table.b, table.c
+                colors = table.colors
+                rows += len(ops) - table.shared
+                crt = table.shared
+                continue
+            op = ops[crt]
+            if metrics is not None:
+                now = time.perf_counter()
+                if prev_op is not None:
+                    metrics.record_op(prev_op, now - prev_time)
+                prev_op, prev_time = op, now
+            if op == Opcodes.SECTION.value:
                 if verbose:
                     self._log(self.tabs, "===Section===")
                 self.tabs += '\t'
-                self.sect_pos.append(crt + 1)
+                self.sect_pos.append(table.position(crt + 1))
                 self.sleep_multipliers.append(
                     1 if not self.sleep_multipliers else self.sleep_multipliers[-1]
                 )
-                self.state_stack.append(
-                    self.original_color.copy()
-                )
+                self.state_stack.append(state.snapshot())
                 crt += 1
                 continue
-            elif cmd[0] == Opcodes.END_SECTION.value:
+            elif op == Opcodes.DEFINE.value:
+                crt = arg_b[crt]
+                continue
+            elif op == Opcodes.CALL.value:
+                if verbose:
+                    self._log(self.tabs, f"call {crt} -> {arg_a[crt]}")
+                calls.append(table.position(crt + 1))
+                crt = table.seek(arg_a[crt])
+                continue
+            elif op == Opcodes.RETURN.value:
+                crt = table.seek(calls.pop())
+                continue
+            elif op == Opcodes.END_SECTION.value:
                 if len(self.tabs):
                     self.tabs = self.tabs[:-1]
                 if verbose:
@@ -203,135 +239,120 @@ class NeoPixelInterpretor:
                 continue
 
             if self.should_stop():
+                reason = 'stopped'
                 break
 
-            if test and time.time() - start_time > self.test_time:
+            if test and self.clock() - start_time > self.test_time:
+                reason = 'test_time'
                 break
 
-            if not test and time.time() - start_time > self.runtime:
+            if not test and self.clock() - start_time > self.runtime:
+                reason = 'runtime'
                 break
 
-            if cmd[0] == Opcodes.SET.value:
-                px_c = self.c2p(cmd[2])
-                self.original_color[cmd[1]] = cmd[2]
-                if not mock:
-                    self.pixels[cmd[1]] = px_c
+            if self.max_instructions is not None and played >= self.max_instructions:
+                reason = 'instructions'
+                break
+
+            played += 1
+
+            if op == Opcodes.SET.value:
+                index, color = arg_a[crt], colors[arg_b[crt]]
+                state.set(index, color, out)
                 if verbose:
-                    self._log(self.tabs, f"set[{cmd[1]}] = {px_c}")
-            elif cmd[0] == Opcodes.FILL.value:
-                px_c = self.c2p(cmd[1])
-                self.original_color = [cmd[1] for _ in range(len(self.original_color))]
-                if not mock:
-                    self.pixels.fill(px_c)
+                    self._log(self.tabs, f"set[{index}] = {self.c2p(color)}")
+            elif op == Opcodes.FILL.value:
+                color = colors[arg_b[crt]]
+                state.fill(color, out)
                 if verbose:
-                    self._log(self.tabs, f"fill({px_c})")
-            elif cmd[0] == Opcodes.SLEEP.value:
-                sleep_now = self.compute_should_sleep(cmdlist, crt)
-                sleep_value = cmdlist[crt][1] * self.sleep_multipliers[-1]
-                if sleep_now:
+                    self._log(self.tabs, f"fill({self.c2p(color)})")
+            elif op == Opcodes.SLEEP.value:
+                seconds = arg_a[crt] / 1000
+                if seconds > 0:
                     if verbose:
-                        if cmdlist[crt][1] != cmdlist[crt][2]:
-                            self._log(self.tabs, f"sleep({sleep_now + sleep_value})")
-                        else:
-                            self._log(self.tabs, f"sleep({sleep_now})")
-                    if not mock and sleep_now:
-                        time.sleep(sleep_now)
-                        if cmdlist[crt][1] != cmdlist[crt][2]:
-                            continue
-            elif cmd[0] == Opcodes.SHOW.value:
+                        self._log(self.tabs, f"sleep({seconds})")
+                    if not mock:
+                        self.scheduler.advance(seconds)
+                        if self.scheduler.wait(self.should_stop) and metrics is not None:
+                            metrics.record_sleep(self.scheduler.errors[-1])
+            elif op == Opcodes.SHOW.value:
                 if not mock:
-                    self.pixels.show()
+                    self._show(state, out)
                 if verbose:
                     self._log(self.tabs, "show()")
-            elif cmd[0] == Opcodes.MOVE_UP.value:
-                lb, ub, sp = cmd[1:4]
-                trail, rotate, show = cmd[4:7]
-                vector = self.original_color[lb:ub + 1].copy()
-                vector = (vector[-sp:] if rotate else (
-                    [vector[0] for _ in range(sp)] if trail else [(0, 0, 0, 0) for _ in range(sp)]
-                )) + vector[:-sp]
-
-                for i in range(ub + 1 - lb):
-                    self.original_color[lb + i] = vector[i]
-                    if not mock and 0 <= lb + i < self.num_px:
-                        self.pixels[lb + i] = self.c2p(vector[i])
-
-                if not mock and show:
-                    self.pixels.show()
-                if verbose:
-                    self._log(self.tabs, f"move_up([{lb}, {ub}], spaces={sp}"
-                                    f"{', trail' if trail else ''}"
-                                    f"{', rotate' if rotate else ''})"
-                              )
-                    if show:
-                        self._log(self.tabs, "show()")
-            elif cmd[0] == Opcodes.MOVE_DOWN.value:
-                lb, ub, sp = cmd[1:4]
-                trail, rotate, show = cmd[4:7]
-                vector = self.original_color[lb:ub + 1].copy()
-
-                vector = vector[sp:] + (
-                    vector[sp:] if rotate else (
-                        [vector[ub] for _ in range(sp)] if trail else [(0, 0, 0, 0) for _ in range(sp)]
-                    )
-                )
-
-                for i in range(ub + 1 - lb):
-                    self.original_color[lb + i] = vector[i]
-                    if not mock:
-                        self.pixels[lb + i] = self.c2p(vector[i])
+            elif op == Opcodes.MOVE_UP.value or op == Opcodes.MOVE_DOWN.value:
+                down = op == Opcodes.MOVE_DOWN.value
+                lb, ub, sp = arg_a[crt], arg_b[crt], arg_c[crt] >> 3
+                trail, rotate, show = (arg_c[crt] >> 2) & 1, (arg_c[crt] >> 1) & 1, arg_c[crt] & 1
+                state.move(lb, ub, sp, trail, rotate, down, out)
 
                 if not mock and show:
-                    self.pixels.show()
+                    self._show(state, out)
                 if verbose:
-                    self._log(self.tabs, f"move_down([{lb}, {ub}], spaces={sp}"
+                    self._log(self.tabs, f"{'move_down' if down else 'move_up'}([{lb}, {ub}], spaces={sp}"
                                     f"{', trail' if trail else ''}"
                                     f"{', rotate' if rotate else ''})"
                               )
                     if show:
                         self._log(self.tabs, "show()")
-            elif cmd[0] == Opcodes.REPEAT.value:
+            elif op == Opcodes.REPEAT.value:
+                key = table.position(crt)
+                times = remaining.get(key, arg_a[crt])
                 if verbose:
-                    self._log(self.tabs, f"> loop {cmd[1]} times")
+                    self._log(self.tabs, f"> loop {times} times")
                 if not mock:
-                    if cmd[1] - 1 > 0:
-                        cmdlist[crt][1] -= 1
-                        crt = self.sect_pos[-1]
-                        for index in range(len(self.pixels)):
-                            self.original_color[index] = self.state_stack[-1][index]
-                            self.pixels[index] = self.c2p(self.original_color[index])
+                    if times - 1 > 0:
+                        remaining[key] = times - 1
+                        crt = table.seek(self.sect_pos[-1])
+                        state.restore(self.state_stack[-1], out)
                         self.sleep_multipliers[-1] = 1 if len(self.sleep_multipliers) == 1 else self.sleep_multipliers[-2]
                         continue
                     else:
-                        cmdlist[crt][1] = cmdlist[crt][2]
-            elif cmd[0] == Opcodes.SET_MULTIPLE.value:
+                        remaining.pop(key, None)
+            elif op == Opcodes.SET_MULTIPLE.value:
+                offset, count = arg_a[crt], arg_b[crt]
+                entries = [
+                    (table.multi_index[j], colors[table.multi_color[j]])
+                    for j in range(offset, offset + count)
+                ]
                 if verbose:
                     self._log(self.tabs, "===SET===")
                     self.tabs += '\t'
-                    for s in cmd[1]:
+                    for s in entries:
                         self._log(self.tabs, f"set[{s[0]}] = {self.c2p(s[1])}")
                     self.tabs = self.tabs[:-1]
                     self._log(self.tabs, "===END=SET===")
 
-                for index, color in cmd[1]:
-                    self.original_color[index] = color
-                    if not mock:
-                        self.pixels[index] = self.c2p(color)
-            elif cmd[0] == Opcodes.SHOW_AND_SLEEP.value:
-                cmdlist[crt][0] = Opcodes.SLEEP.value
-                continue
-            elif cmd[0] == Opcodes.RESET_SPEED.value:
+                for index, color in entries:
+                    state.set(index, color, out)
+            elif op == Opcodes.SET_BRIGHTNESS.value:
+                index, value = arg_a[crt], arg_b[crt]
+                state.set_brightness(index, value, out)
+                if verbose:
+                    self._log(self.tabs, f"brightness[{index}] = {value}")
+            elif op == Opcodes.RESET_SPEED.value:
                 self.sleep_multipliers[-1] = 1
                 if verbose:
                     self._log(self.tabs, f"reset_speed()")
-            elif cmd[0] == Opcodes.SET_SPEED.value:
-                self.sleep_multipliers[-1] = cmd[1]
+            elif op == Opcodes.SET_SPEED.value:
+                multiplier = arg_a[crt] / 1000
+                self.sleep_multipliers[-1] = multiplier
                 if verbose:
-                    self._log(self.tabs, f"speed = {math.ceil(1 / cmd[1] * 100) / 100}")
+                    self._log(self.tabs, f"speed = {math.ceil(1 / multiplier * 100) / 100}")
             else:
-                raise ValueError(f"Invalid opcode in command! Got {cmd[0]}")
+                raise ValueError(f"Invalid opcode in command! Got {op}")
 
             crt += 1
 
+        if metrics is not None and prev_op is not None:
+            metrics.record_op(prev_op, time.perf_counter() - prev_time)
+
         if self.pixels and not isinstance(self.pixels, list):
             self.pixels.fill((0, 0, 0))
+
+        if mock:
+            return None
+        self.progress = self._progress(
+            reason, start_time, min(self.scheduler.deadline, self.clock()) - self.scheduler.origin, played, rows
+        )
+        return self.progress
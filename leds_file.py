@@ -0,0 +1,267 @@
+import math
+import mmap
+import struct
+import zlib
+
+from analyzer import Analysis
+from decoder import decode, scan, OP_SECTION, OP_REPEAT, OP_RETURN
+
+MAGIC = b'LEDS'
+VERSION = 2
+# magic, version, flags, pixel count, duration in ms, frames, shows, instructions, program length, CRC-32
+_HEADER = struct.Struct('>4sBBHIIIIII')
+HEADER_SIZE = _HEADER.size
+MAX_NUM_PX = 0xffff
+
+# Header flag: the program is stored as independently compressed chunks behind a chunk index, instead of
+# one zlib stream. The index is a u32 chunk count and a (compressed size, length, CRC-32) entry per chunk
+CHUNKED = 0x01
+FLAGS = CHUNKED
+_COUNT = struct.Struct('>I')
+_CHUNK = struct.Struct('>III')
+# Program bytes per chunk, a chunk only ends where no section still to be repeated is open
+CHUNK_SIZE = 256 * 1024
+
+
+# Header of a v2 .leds file: what the static analysis of the program found, so a file can be checked and
+# listed without decompressing it. v1 files are a bare zlib stream of the program and have no header
+class Header:
+    def __init__(self, num_px, duration, frames, shows, instructions, length, checksum, version=VERSION, flags=0):
+        self.version = version
+        self.flags = flags
+        self.num_px = num_px
+        self.duration = duration
+        self.frames = frames
+        self.shows = shows
+        self.instructions = instructions
+        self.length = length
+        self.checksum = checksum
+
+    def analysis(self):
+        return Analysis(self.duration, self.shows, self.frames, self.instructions)
+
+    def pack(self):
+        return _HEADER.pack(
+            MAGIC, self.version, self.flags, self.num_px, math.ceil(self.duration * 1000), self.frames,
+            self.shows, self.instructions, self.length, self.checksum
+        )
+
+    @property
+    def chunked(self):
+        return bool(self.flags & CHUNKED)
+
+    def __repr__(self):
+        return f'Header(v{self.version}, {self.num_px}px, {self.duration:.3f}s, {self.frames} frames, ' \
+               f'{self.length} bytes)'
+
+
+# Byte ranges of the chunks of a program. The first one holds the subroutine definitions (empty without
+# subroutines) and is decoded ahead of every other chunk. The others end at the first instruction after
+# chunk_size bytes where every open section stays open until the end of the program, so the interpreter
+# never jumps back into a previous chunk
+def split(data, chunk_size=CHUNK_SIZE):
+    stack = []
+    prelude = 0
+    for start, op, end in scan(data):
+        if op == OP_SECTION:
+            stack.append(start)
+        elif op == OP_REPEAT and stack:
+            stack.pop()
+        elif op == OP_RETURN:
+            prelude = end
+    unclosed = set(stack)
+
+    spans = [(0, prelude)]
+    stack = []
+    # Open sections that a later REPEAT jumps back to
+    closed = 0
+    chunk_start = prelude
+    for start, op, end in scan(memoryview(data)[prelude:]):
+        start += prelude
+        if not closed and start - chunk_start >= chunk_size:
+            spans.append((chunk_start, start))
+            chunk_start = start
+        if op == OP_SECTION:
+            stack.append(start)
+            closed += start not in unclosed
+        elif op == OP_REPEAT and stack:
+            closed -= stack.pop() not in unclosed
+    spans.append((chunk_start, len(data)))
+    return spans
+
+
+# v2 file contents for a program compiled for num_px pixels, analysis is analyze(data). With a chunk_size
+# the program is stored in chunks that ChunkedProgram decompresses one at a time
+def pack(data, num_px, analysis, level=9, chunk_size=None):
+    if not 0 < num_px <= MAX_NUM_PX:
+        raise ValueError(f"Pixel count {num_px} does not fit in a v2 header")
+    header = Header(
+        num_px, analysis.duration, analysis.frames, analysis.shows, analysis.instructions, len(data),
+        zlib.crc32(data), flags=CHUNKED if chunk_size else 0
+    )
+    if not chunk_size:
+        return header.pack() + zlib.compress(data, level)
+    parts = [header.pack(), b'']
+    index = [_COUNT.pack(0)]
+    for start, end in split(data, chunk_size):
+        chunk = bytes(data[start:end])
+        compressed = zlib.compress(chunk, level)
+        index.append(_CHUNK.pack(len(compressed), len(chunk), zlib.crc32(chunk)))
+        parts.append(compressed)
+    index[0] = _COUNT.pack(len(index) - 1)
+    parts[1] = b''.join(index)
+    return b''.join(parts)
+
+
+# The header at the start of a file, None for a v1 file
+def parse_header(prefix):
+    if prefix[:len(MAGIC)] != MAGIC:
+        return None
+    if len(prefix) < HEADER_SIZE:
+        raise ValueError("Truncated .leds header")
+    magic, version, flags, num_px, duration, frames, shows, instructions, length, checksum = \
+        _HEADER.unpack_from(prefix)
+    if version != VERSION:
+        raise ValueError(f"Unsupported .leds version {version}")
+    if flags & ~FLAGS:
+        raise ValueError(f"Unsupported .leds flags {flags:#x}")
+    return Header(num_px, duration / 1000, frames, shows, instructions, length, checksum, version, flags)
+
+
+# (offset, compressed size, length, CRC-32) of every chunk of a chunked file. The chunk lengths must add up
+# to the program length of the header, and none may be longer than max_chunk, so that nothing is inflated
+# past what the header announced
+def read_index(contents, header, max_chunk=None):
+    if len(contents) < HEADER_SIZE + _COUNT.size:
+        raise ValueError("Truncated .leds chunk index")
+    count = _COUNT.unpack_from(contents, HEADER_SIZE)[0]
+    offset = HEADER_SIZE + _COUNT.size + count * _CHUNK.size
+    if offset > len(contents):
+        raise ValueError("Truncated .leds chunk index")
+    chunks = []
+    total = 0
+    for size, length, checksum in _CHUNK.iter_unpack(contents[HEADER_SIZE + _COUNT.size:offset]):
+        total += length
+        if total > header.length:
+            raise ValueError("Chunks are longer than the program length in the .leds header")
+        if max_chunk is not None and length > max_chunk:
+            raise ValueError(f"Chunk at offset {offset} is longer than {max_chunk} bytes")
+        chunks.append((offset, size, length, checksum))
+        offset += size
+    if total != header.length:
+        raise ValueError("Chunks are shorter than the program length in the .leds header")
+    if offset > len(contents):
+        raise ValueError("Truncated .leds chunk")
+    return chunks
+
+
+# Inflates a zlib stream without producing more than limit bytes. Raises ValueError for a longer or
+# truncated stream
+def inflate(compressed, limit):
+    inflater = zlib.decompressobj()
+    data = inflater.decompress(compressed, limit + 1)
+    if len(data) > limit:
+        raise ValueError(f"Program decompresses to more than {limit} bytes")
+    if not inflater.eof:
+        raise ValueError("Incomplete or truncated zlib stream")
+    return data
+
+
+def inflate_chunk(contents, chunk):
+    offset, size, length, checksum = chunk
+    data = inflate(contents[offset:offset + size], length)
+    if len(data) != length or zlib.crc32(data) != checksum:
+        raise ValueError(f"Chunk at offset {offset} does not match its checksum")
+    return data
+
+
+def read_header(path):
+    with open(path, 'rb') as fd:
+        return parse_header(fd.read(HEADER_SIZE))
+
+
+# (header, program) of the contents of a v1 or v2 file, v2 programs are checked against their length and
+# checksum. Programs longer than limit, or than the length in their header, are rejected before they are
+# inflated whole. Raises ValueError or zlib.error for a damaged file
+def unpack(contents, limit=None):
+    header = parse_header(contents)
+    if header is None:
+        return None, zlib.decompress(contents) if limit is None else inflate(contents, limit)
+    if limit is not None and header.length > limit:
+        raise ValueError(f"Program decompresses to more than {limit} bytes")
+    if header.chunked:
+        data = b''.join(inflate_chunk(contents, chunk) for chunk in read_index(contents, header))
+    else:
+        data = inflate(memoryview(contents)[HEADER_SIZE:], header.length)
+    if len(data) != header.length or zlib.crc32(data) != header.checksum:
+        raise ValueError("Program does not match the checksum in its .leds header")
+    return header, data
+
+
+def load(path, limit=None):
+    with open(path, 'rb') as fd:
+        return unpack(fd.read(), limit)
+
+
+# A chunked file mapped in memory. Playing it only keeps the subroutine definitions and the chunk being
+# played decoded, whatever the length of the program. Files with a chunk longer than max_chunk are rejected
+class ChunkedProgram:
+    def __init__(self, path, max_chunk=None):
+        with open(path, 'rb') as fd:
+            self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.header = parse_header(self.map[:HEADER_SIZE])
+            if self.header is None or not self.header.chunked:
+                raise ValueError(f"{path} is not a chunked .leds file")
+            self.chunks = read_index(self.map, self.header, max_chunk)
+            if len(self.chunks) < 2:
+                raise ValueError(f"{path} has no program chunk")
+            # Subroutine definitions, copied in front of every chunk so calls into them resolve
+            self.prelude = decode(self.chunk(0))
+        except BaseException:
+            self.map.close()
+            raise
+
+    def chunk(self, index):
+        return inflate_chunk(self.map, self.chunks[index])
+
+    def _tables(self):
+        for index in range(1, len(self.chunks)):
+            table = self.prelude.copy()
+            if index == 1:
+                table.append(OP_SECTION)
+            else:
+                table.shared = len(table)
+            yield decode(self.chunk(index), table)
+
+    # Table of the first chunk, as NeoPixelInterpretor.build_cmd_q would decode it. The interpreter gets the
+    # next ones from its following() when it reaches the end of a chunk
+    def open_table(self):
+        tables = self._tables()
+
+        def following():
+            table = next(tables, None)
+            if table is not None:
+                table.following = following
+            return table
+
+        return following()
+
+    # Decoded size kept between plays, the mapped file itself is paged in and out by the kernel
+    def nbytes(self):
+        return self.prelude.nbytes() + len(self.chunks) * _CHUNK.size
+
+    # Inflates every chunk once and checks the whole program against the header, without holding more than
+    # a chunk in memory
+    def verify(self):
+        length = 0
+        checksum = 0
+        for index in range(len(self.chunks)):
+            data = self.chunk(index)
+            length += len(data)
+            checksum = zlib.crc32(data, checksum)
+        if length != self.header.length or checksum != self.header.checksum:
+            raise ValueError("Program does not match the checksum in its .leds header")
+
+    def close(self):
+        self.map.close()
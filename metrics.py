@@ -0,0 +1,128 @@
+import bisect
+from array import array
+
+from opcodes import Opcodes
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = array('L', [0] * (len(buckets) + 1))
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            'buckets': [[bound, count] for bound, count in zip(self.buckets + ('+Inf',), self.counts)],
+            'count': sum(self.counts),
+            'sum': self.total,
+            'max': self.max,
+        }
+
+
+# Hot-path counters filled by the interpreter when it is given a Metrics object. With metrics disabled the
+# interpreter only pays for a None check per instruction
+class Metrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.op_counts = array('Q', [0] * 256)
+        self.op_time = array('d', [0.0] * 256)
+        self.show_latency = Histogram()
+        self.sleep_overshoot = Histogram()
+        self.sleep_undershoot = Histogram()
+        self.decodes = 0
+        self.decode_time = 0.0
+        self.decode_last = 0.0
+        self.first_frames = 0
+        self.first_frame_time = 0.0
+        self.first_frame_last = 0.0
+        # Output and scheduler statistics of the last run on each strip, by strip name
+        self.runs = {}
+        self.program_cache = {}
+
+    def record_op(self, op, seconds):
+        self.op_counts[op] += 1
+        self.op_time[op] += seconds
+
+    def record_show(self, seconds):
+        self.show_latency.observe(seconds)
+
+    def record_sleep(self, error):
+        if error >= 0:
+            self.sleep_overshoot.observe(error)
+        else:
+            self.sleep_undershoot.observe(-error)
+
+    def record_decode(self, seconds):
+        self.decodes += 1
+        self.decode_time += seconds
+        self.decode_last = seconds
+
+    # Seconds from the start of a run to its first frame
+    def record_first_frame(self, seconds):
+        self.first_frames += 1
+        self.first_frame_time += seconds
+        self.first_frame_last = seconds
+
+    def record_run(self, strip, output, timing):
+        self.runs[strip] = {'output': output, 'timing': timing}
+
+    def record_program_cache(self, stats):
+        self.program_cache = stats
+
+    def snapshot(self):
+        return {
+            'opcodes': {
+                op.name: {'count': self.op_counts[op.value], 'seconds': self.op_time[op.value]}
+                for op in Opcodes
+                if self.op_counts[op.value]
+            },
+            'show_latency': self.show_latency.snapshot(),
+            'sleep_overshoot': self.sleep_overshoot.snapshot(),
+            'sleep_undershoot': self.sleep_undershoot.snapshot(),
+            'decode': {'count': self.decodes, 'seconds': self.decode_time, 'last': self.decode_last},
+            'first_frame': {
+                'count': self.first_frames, 'seconds': self.first_frame_time, 'last': self.first_frame_last
+            },
+            'runs': dict(self.runs),
+            'program_cache': self.program_cache,
+        }
+
+    def to_text(self):
+        snap = self.snapshot()
+        lines = []
+        for name, op in snap['opcodes'].items():
+            lines.append(f'opcode_count{{op="{name}"}} {op["count"]}')
+            lines.append(f'opcode_seconds{{op="{name}"}} {op["seconds"]:.6f}')
+        for metric in ('show_latency', 'sleep_overshoot', 'sleep_undershoot'):
+            histogram = snap[metric]
+            cumulative = 0
+            for bound, count in histogram['buckets']:
+                cumulative += count
+                lines.append(f'{metric}_seconds_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_seconds_count {histogram["count"]}')
+            lines.append(f'{metric}_seconds_sum {histogram["sum"]:.6f}')
+            lines.append(f'{metric}_seconds_max {histogram["max"]:.6f}')
+        lines.append(f'decode_count {snap["decode"]["count"]}')
+        lines.append(f'decode_seconds_sum {snap["decode"]["seconds"]:.6f}')
+        lines.append(f'decode_seconds_last {snap["decode"]["last"]:.6f}')
+        lines.append(f'first_frame_count {snap["first_frame"]["count"]}')
+        lines.append(f'first_frame_seconds_sum {snap["first_frame"]["seconds"]:.6f}')
+        lines.append(f'first_frame_seconds_last {snap["first_frame"]["last"]:.6f}')
+        for strip, run in snap['runs'].items():
+            for group, values in run.items():
+                for name, value in values.items():
+                    lines.append(f'last_run_{group}_{name}{{strip="{strip}"}} {value}')
+        for name, value in snap['program_cache'].items():
+            lines.append(f'program_cache_{name} {value}')
+        return '\n'.join(lines) + '\n'
@@ -1,23 +1,41 @@
 import math
 import os
-import zlib
 from contextlib import contextmanager
 
+import leds_file
+from analyzer import analyze
+from decoder import InstructionTable
 from opcodes import Opcodes
 from interpretor import NeoPixelInterpretor
+from optimizer import optimize
+from subroutines import deduplicate
+
+# Pixels past this index are written with the 16-bit index opcodes
+MAX_NARROW_INDEX = 0xff
+# Longer programs are saved in chunks, so the server plays them without decompressing them whole
+CHUNKED_ABOVE = 4 * 1024 * 1024
 
 
 class Neopixel:
-    def __init__(self, num_px, filename, verbose=False):
+    def __init__(self, num_px, filename, verbose=False, pipeline=None, optimize=True, subroutines=True,
+                 chunk_size=None):
+        if num_px < 1 or num_px > leds_file.MAX_NUM_PX:
+            raise ValueError(f"Pixel count should be in interval [1, {leds_file.MAX_NUM_PX}]")
         self.num_px = num_px
+        self.optimize = optimize
+        self.subroutines = subroutines
+        # Program bytes per chunk of the saved file, by default only programs over CHUNKED_ABOVE are chunked
+        self.chunk_size = chunk_size
         self.filename = filename
-        self.interpretor = NeoPixelInterpretor(None, num_px=num_px)
+        self.interpretor = NeoPixelInterpretor(None, num_px=num_px, pipeline=pipeline)
         self.warnings = set()
         self.verbose = verbose
 
         self.fd = open(self.filename, 'wb')
-        self.data = b''
-        self.stack_sleep = []
+        self.data = bytearray()
+        # Decoded form of self.data, built alongside it so the preview never decodes the compiled bytes
+        self.table = InstructionTable()
+        self.open_sections = 0
         self.section()
 
     def __process_color(self, color):
@@ -55,7 +73,14 @@ class Neopixel:
             raise TypeError("Slices are not accepted")
         self.__validate_index(key)
         value = self.__process_color(value)
-        self._w(Opcodes.SET, int.to_bytes(key, 1, byteorder='big'), self._rgbl_to_bytes(value))
+        color = self._rgbl_to_bytes(value)
+        if key < 0:
+            key += self.num_px
+        wide = key > MAX_NARROW_INDEX
+        self._w(
+            [(Opcodes.SET, key, self._color_id(color))],
+            Opcodes.SET_WIDE if wide else Opcodes.SET, int.to_bytes(key, 2 if wide else 1, byteorder='big'), color
+        )
 
     def __getitem__(self, index):
         return self.interpretor.original_color[index]
@@ -73,72 +98,80 @@ class Neopixel:
 
         return ((new_color[0] << 24) + (new_color[1] << 16) + (new_color[2] << 8) + new_color[3]).to_bytes(4, byteorder='big')
 
-    def _w(self, *data):
-        buffer = b''
+    def _color_id(self, color):
+        return self.table.color_id(int.from_bytes(color, byteorder='big'))
+
+    def _w(self, rows, *data):
+        buffer = bytearray()
         for d in data:
             if isinstance(d, tuple):
                 buffer += self._rgbl_to_bytes(d)
             elif isinstance(d, Opcodes):
-                buffer += d.value.to_bytes(1, byteorder='big')
+                buffer.append(d.value)
             else:
                 buffer += d
-        self.interpretor.interpret_and_mock_run(buffer, verbose=self.verbose)
+        start = len(self.table)
+        for row in rows:
+            self.table.append(row[0].value, *row[1:])
+        self.interpretor.do(self.table, mock=True, verbose=self.verbose, start=start)
         self.data += buffer
 
     def sleep(self, time):
         if time < 0 or time > 60:
             raise ValueError("Time to sleep should be in interval [0, 60]s")
         milliseconds = math.ceil(time * 1000 * self.interpretor.sleep_multipliers[-1])
-        self.stack_sleep[-1] += milliseconds
-        self._w(Opcodes.SLEEP, int.to_bytes(milliseconds & 0xffff, 2, byteorder='big'))
+        self._w(
+            [(Opcodes.SLEEP, milliseconds & 0xffff)],
+            Opcodes.SLEEP, int.to_bytes(milliseconds & 0xffff, 2, byteorder='big')
+        )
 
     def accelerate(self, delta_multiplier=0.005):
         if self.interpretor.sleep_multipliers[-1] - delta_multiplier <= 0:
             raise ValueError("Accelerates too much!")
         multiplier = self.interpretor.sleep_multipliers[-1] - delta_multiplier
-        multi = math.ceil(multiplier * 1000)
-        self._w(Opcodes.SET_SPEED, int.to_bytes(multi, 2, byteorder='big'))
+        self._set_speed(math.ceil(multiplier * 1000))
 
     def decelerate(self, delta_multiplier=0.005):
         if self.interpretor.sleep_multipliers[-1] + delta_multiplier >= 100:
             raise ValueError("Decelerates too much")
         multiplier = self.interpretor.sleep_multipliers[-1] + delta_multiplier
-        multi = math.ceil(multiplier * 1000)
-        self._w(Opcodes.SET_SPEED, int.to_bytes(multi, 2, byteorder='big'))
+        self._set_speed(math.ceil(multiplier * 1000))
 
     def set_multiplier(self, multiplier):
         if multiplier <= 0 or multiplier >= 100:
             raise ValueError("Multiplier should be in range [0, 100]")
-        multi = math.ceil(multiplier * 1000)
-        self._w(Opcodes.SET_SPEED, int.to_bytes(multi, 2, byteorder='big'))
+        self._set_speed(math.ceil(multiplier * 1000))
+
+    def _set_speed(self, multi):
+        self._w([(Opcodes.SET_SPEED, multi)], Opcodes.SET_SPEED, int.to_bytes(multi, 2, byteorder='big'))
 
     def reset_speed(self):
-        self._w(Opcodes.RESET_SPEED)
+        self._w([(Opcodes.RESET_SPEED,)], Opcodes.RESET_SPEED)
 
     def get_speed(self):
         return 1 / self.interpretor.sleep_multipliers[-1] if self.interpretor.sleep_multipliers else 1
 
     def fill(self, color):
-        color = self.__process_color(color)
-        self._w(Opcodes.FILL, color)
+        color = self._rgbl_to_bytes(self.__process_color(color))
+        self._w([(Opcodes.FILL, 0, self._color_id(color))], Opcodes.FILL, color)
 
     def show(self, sleep=None):
         if not sleep:
-            self._w(Opcodes.SHOW)
+            self._w([(Opcodes.SHOW,)], Opcodes.SHOW)
             return
 
         if sleep < 0 or sleep > 60:
             raise ValueError("Time to sleep should be in interval [0, 60]")
         milliseconds = math.ceil(sleep * 1000 * self.interpretor.sleep_multipliers[-1])
-        self.stack_sleep[-1] += milliseconds
         self._w(
+            [(Opcodes.SHOW,), (Opcodes.SLEEP, milliseconds & 0xffff)],
             Opcodes.SHOW_AND_SLEEP,
             int.to_bytes(milliseconds & 0xffff, 2, byteorder='big')
         )
 
     def section(self):
-        self.stack_sleep.append(0)
-        self._w(Opcodes.SECTION)
+        self.open_sections += 1
+        self._w([(Opcodes.SECTION,)], Opcodes.SECTION)
 
     @contextmanager
     def section_repeat(self, times=1):
@@ -146,35 +179,32 @@ class Neopixel:
         yield
         self.repeat(times)
 
-    def _merge_sleep_time(self, times):
-        if len(self.stack_sleep) > 1:
-            top_stack_time = self.stack_sleep.pop() * (times + 1)
-            self.stack_sleep[-1] += top_stack_time
-        else:
-            self.stack_sleep[0] *= times
-
     def repeat(self, times=1):
         if times < 1 or times > 0xffff:
             raise ValueError(f"Repeat times should be in interval [0, {0xffff}]")
-        self._merge_sleep_time(times)
-        self._w(Opcodes.REPEAT, int.to_bytes(times & 0xffff, 2, byteorder='big'))
+        self.open_sections -= 1
+        self._w(
+            [(Opcodes.REPEAT, times & 0xffff), (Opcodes.END_SECTION,)],
+            Opcodes.REPEAT, int.to_bytes(times & 0xffff, 2, byteorder='big')
+        )
 
-    def _process_set_pixel(self, index, value):
+    def _process_set_pixel(self, index, value, width=1):
         return [
-            int.to_bytes(index, 1, byteorder='big'),
+            int.to_bytes(index, width, byteorder='big'),
             self._rgbl_to_bytes(value)
         ]
 
     def _write_move_operation(self, opcode, spaces, lower_bound, upper_bound, trail, rotate, occupy):
+        flags = (trail << 2) | (rotate << 1) | occupy
+        width = 2 if max(lower_bound, upper_bound, spaces) > MAX_NARROW_INDEX else 1
+        wide_opcode = Opcodes.MOVE_UP_WIDE if opcode == Opcodes.MOVE_UP else Opcodes.MOVE_DOWN_WIDE
         self._w(
-            opcode,
-            int.to_bytes(lower_bound, 1, byteorder='big'),
-            int.to_bytes(upper_bound, 1, byteorder='big'),
-            int.to_bytes(spaces, 1, byteorder='big'),
-            int.to_bytes(
-                (trail << 2) | (rotate << 1) | occupy,
-                1, byteorder='big'
-            )
+            [(opcode, lower_bound, upper_bound, (spaces << 3) | flags)],
+            wide_opcode if width == 2 else opcode,
+            int.to_bytes(lower_bound, width, byteorder='big'),
+            int.to_bytes(upper_bound, width, byteorder='big'),
+            int.to_bytes(spaces, width, byteorder='big'),
+            int.to_bytes(flags, 1, byteorder='big')
         )
 
     def move_up(self, spaces=1, lower_bound=0, upper_bound=None, trail=False, rotate=False, show=False):
@@ -200,14 +230,21 @@ class Neopixel:
         self.__validate_bounds(lower_bound, upper_bound, 0)
         gradient = self.build_gradient(colors, upper_bound + 1 - lower_bound)
 
+        wide = upper_bound > MAX_NARROW_INDEX or len(gradient) > 0xff
+        width = 2 if wide else 1
         gradient_buffer = []
         for index in range(len(gradient)):
             gradient_buffer += self._process_set_pixel(
-                lower_bound + index, gradient[index]
+                lower_bound + index, gradient[index], width
             )
+        count = int.to_bytes(len(gradient), width, byteorder='big')
+        offset = len(self.table.multi_index)
+        self.table.multi_index.extend(range(lower_bound, lower_bound + len(gradient)))
+        self.table.multi_color.extend(self._color_id(color) for color in gradient_buffer[1::2])
         self._w(
-            Opcodes.SET_MULTIPLE,
-            int.to_bytes(len(gradient), 1, byteorder='big'),
+            [(Opcodes.SET_MULTIPLE, offset, len(gradient))],
+            Opcodes.SET_MULTIPLE_WIDE if wide else Opcodes.SET_MULTIPLE,
+            count,
             *gradient_buffer
         )
 
@@ -251,9 +288,11 @@ class Neopixel:
         return gradient
 
     def _set_brightness(self, key, value):
+        wide = key > MAX_NARROW_INDEX
         self._w(
-            Opcodes.SET_BRIGHTNESS,
-            int.to_bytes(key, 1, byteorder='big'),
+            [(Opcodes.SET_BRIGHTNESS, key, value)],
+            Opcodes.SET_BRIGHTNESS_WIDE if wide else Opcodes.SET_BRIGHTNESS,
+            int.to_bytes(key, 2 if wide else 1, byteorder='big'),
             int.to_bytes(value, 1, byteorder='big')
         )
 
@@ -279,21 +318,35 @@ class Neopixel:
         self._set_brightness(key, value)
 
     def save(self):
-        if len(self.stack_sleep) > 1:
+        if self.open_sections > 1:
             self.warnings.add('Sections started but not finished')
 
-        total_sleep = sum(self.stack_sleep)
-        if total_sleep == 0:
+        data = self.data
+        if self.optimize:
+            data = optimize(data)
+        if self.subroutines:
+            data = deduplicate(data)
+        if len(data) < len(self.data):
+            print(f"Optimized program: {len(self.data)} -> {len(data)} bytes")
+
+        analysis = analyze(data)
+        total_sleep = int(analysis.duration * 1000)
+        if analysis.duration == 0:
             self.warnings.add("Program time is zero!")
-        sequence_time = f'{total_sleep // 60000}' + (f':{int(total_sleep / 1000 % 60)}' if int(total_sleep / 1000) % 60 > 0 else '')
-        print("Sequence length: approx. {0} minutes".format(sequence_time))
+        sequence_time = f'{total_sleep // 60000}' + (f':{int(total_sleep / 1000 % 60):02}' if int(total_sleep / 1000) % 60 > 0 else '')
+        print("Sequence length: {0} minutes, {1} frames ({2} shows)".format(
+            sequence_time, analysis.frames, analysis.shows
+        ))
         print("Hint: use -v argument to see compiled program")
-        if total_sleep // 1000 > 180:
+        if analysis.duration > 180:
             self.warnings.add('Animation time exceeds 3 minutes')
-        self.fd.write(zlib.compress(self.data, 9))
+        chunk_size = self.chunk_size
+        if chunk_size is None and len(data) > CHUNKED_ABOVE:
+            chunk_size = leds_file.CHUNK_SIZE
+        self.fd.write(leds_file.pack(data, self.num_px, analysis, chunk_size=chunk_size))
         self.fd.close()
         print("Compressed {0} bytes in {1} - final size: {2} bytes.".format(
-            len(self.data),
+            len(data),
             self.filename,
             os.path.getsize(self.filename))
         )
@@ -304,4 +357,5 @@ class Neopixel:
                 print(warning)
             print("======================================")
             print()
+        return analysis
 
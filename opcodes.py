@@ -19,6 +19,17 @@ class Opcodes(Enum):
     SET_MULTIPLE = 0x0c
     SET_BRIGHTNESS = 0x0d
 
+    DEFINE = 0x0e
+    CALL = 0x0f
+    RETURN = 0x10
+
+    # 16-bit pixel index (and SET_MULTIPLE count) variants, for strips longer than 256 pixels
+    SET_WIDE = 0x11
+    SET_MULTIPLE_WIDE = 0x12
+    MOVE_UP_WIDE = 0x13
+    MOVE_DOWN_WIDE = 0x14
+    SET_BRIGHTNESS_WIDE = 0x15
+
 
     # runtime opcodes
     END_SECTION = 0xff
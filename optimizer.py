@@ -0,0 +1,245 @@
+import argparse
+import os
+import struct
+import sys
+import zlib
+
+import leds_file
+from analyzer import analyze
+from decoder import scan, OP_SET, OP_FILL, OP_SLEEP, OP_SHOW, OP_SHOW_AND_SLEEP, OP_MOVE_UP, OP_MOVE_DOWN, \
+    OP_SET_SPEED, OP_RESET_SPEED, OP_SET_MULTIPLE, OP_SET_BRIGHTNESS, OP_SET_WIDE, OP_SET_MULTIPLE_WIDE, \
+    OP_MOVE_UP_WIDE, OP_MOVE_DOWN_WIDE, OP_SET_BRIGHTNESS_WIDE
+
+_U16 = struct.Struct('>H')
+_COLOR = struct.Struct('>I')
+_SET = struct.Struct('>BI')
+_BRIGHTNESS = struct.Struct('>BB')
+_SET_WIDE = struct.Struct('>HI')
+_BRIGHTNESS_WIDE = struct.Struct('>HB')
+
+MAX_SLEEP = 0xffff
+MAX_MULTIPLE = 0xff
+MAX_MULTIPLE_WIDE = 0xffff
+# Pixels past this index need the wide opcodes
+MAX_NARROW_INDEX = 0xff
+
+
+# Pixel writes since the last observation point, folded down to the final value of every touched pixel.
+# Nothing reaches the strip before the next SHOW, so only the final values matter
+class _Writes:
+    def __init__(self):
+        self.fill = None
+        self.pixels = {}
+
+    def __bool__(self):
+        return self.fill is not None or bool(self.pixels)
+
+    def set(self, index, packed):
+        self.pixels[index] = (OP_SET, packed)
+
+    def set_brightness(self, index, value):
+        current = self.pixels.get(index)
+        if current is None and self.fill is not None:
+            current = (OP_SET, self.fill)
+        if current is not None and current[0] == OP_SET:
+            self.pixels[index] = (OP_SET, (current[1] & 0xffffff00) | value)
+        else:
+            self.pixels[index] = (OP_SET_BRIGHTNESS, value)
+
+    def fill_all(self, packed):
+        self.fill = packed
+        self.pixels.clear()
+
+    def emit(self, out):
+        if self.fill is not None:
+            out.append(OP_FILL)
+            out += _COLOR.pack(self.fill)
+        sets = [
+            (index, value) for index, (op, value) in sorted(self.pixels.items())
+            if op == OP_SET and value != self.fill
+        ]
+        narrow = [entry for entry in sets if entry[0] <= MAX_NARROW_INDEX]
+        wide = sets[len(narrow):]
+        for start in range(0, len(narrow), MAX_MULTIPLE):
+            chunk = narrow[start:start + MAX_MULTIPLE]
+            if len(chunk) == 1:
+                out.append(OP_SET)
+            else:
+                out.append(OP_SET_MULTIPLE)
+                out.append(len(chunk))
+            for index, packed in chunk:
+                out += _SET.pack(index, packed)
+        for start in range(0, len(wide), MAX_MULTIPLE_WIDE):
+            chunk = wide[start:start + MAX_MULTIPLE_WIDE]
+            if len(chunk) == 1:
+                out.append(OP_SET_WIDE)
+            else:
+                out.append(OP_SET_MULTIPLE_WIDE)
+                out += _U16.pack(len(chunk))
+            for index, packed in chunk:
+                out += _SET_WIDE.pack(index, packed)
+        for index, (op, value) in sorted(self.pixels.items()):
+            if op == OP_SET_BRIGHTNESS:
+                if index <= MAX_NARROW_INDEX:
+                    out.append(OP_SET_BRIGHTNESS)
+                    out += _BRIGHTNESS.pack(index, value)
+                else:
+                    out.append(OP_SET_BRIGHTNESS_WIDE)
+                    out += _BRIGHTNESS_WIDE.pack(index, value)
+        self.fill = None
+        self.pixels.clear()
+
+
+class _Optimizer:
+    def __init__(self):
+        self.out = bytearray()
+        self.writes = _Writes()
+        # Pending SLEEP / SET_SPEED / RESET_SPEED as [op, arg], consecutive sleeps are summed and a speed
+        # change that no sleep observes is replaced by the next one
+        self.timing = []
+        self.show = False
+        # False only while the strip is known to show the current state
+        self.dirty = True
+
+    def sleep(self, ms):
+        if not ms:
+            return
+        if self.timing and self.timing[-1][0] == OP_SLEEP:
+            self.timing[-1][1] += ms
+        else:
+            self.timing.append([OP_SLEEP, ms])
+
+    def speed(self, op, arg):
+        if self.timing and self.timing[-1][0] != OP_SLEEP:
+            self.timing[-1] = [op, arg]
+        else:
+            self.timing.append([op, arg])
+
+    def flush(self):
+        out = self.out
+        timing = self.timing
+        if self.show:
+            if timing and timing[0][0] == OP_SLEEP:
+                ms = min(timing[0][1], MAX_SLEEP)
+                out.append(OP_SHOW_AND_SLEEP)
+                out += _U16.pack(ms)
+                timing[0][1] -= ms
+            else:
+                out.append(OP_SHOW)
+            self.show = False
+        for op, arg in timing:
+            if op == OP_SLEEP:
+                while arg:
+                    ms = min(arg, MAX_SLEEP)
+                    out.append(OP_SLEEP)
+                    out += _U16.pack(ms)
+                    arg -= ms
+            elif op == OP_SET_SPEED:
+                out.append(op)
+                out += _U16.pack(arg)
+            else:
+                out.append(op)
+        timing.clear()
+        self.writes.emit(out)
+
+    def run(self, data):
+        mv = memoryview(data)
+        writes = self.writes
+        for start, op, end in scan(data):
+            if op == OP_SET:
+                writes.set(*_SET.unpack_from(mv, start + 1))
+                self.dirty = True
+            elif op == OP_SET_WIDE:
+                writes.set(*_SET_WIDE.unpack_from(mv, start + 1))
+                self.dirty = True
+            elif op == OP_SET_MULTIPLE:
+                for index, packed in _SET.iter_unpack(mv[start + 2:end]):
+                    writes.set(index, packed)
+                self.dirty = True
+            elif op == OP_SET_MULTIPLE_WIDE:
+                for index, packed in _SET_WIDE.iter_unpack(mv[start + 3:end]):
+                    writes.set(index, packed)
+                self.dirty = True
+            elif op == OP_FILL:
+                writes.fill_all(_COLOR.unpack_from(mv, start + 1)[0])
+                self.dirty = True
+            elif op == OP_SET_BRIGHTNESS:
+                writes.set_brightness(*_BRIGHTNESS.unpack_from(mv, start + 1))
+                self.dirty = True
+            elif op == OP_SET_BRIGHTNESS_WIDE:
+                writes.set_brightness(*_BRIGHTNESS_WIDE.unpack_from(mv, start + 1))
+                self.dirty = True
+            elif op == OP_SLEEP:
+                self.sleep(_U16.unpack_from(mv, start + 1)[0])
+            elif op == OP_SET_SPEED:
+                self.speed(op, _U16.unpack_from(mv, start + 1)[0])
+            elif op == OP_RESET_SPEED:
+                self.speed(op, None)
+            elif op == OP_SHOW or op == OP_SHOW_AND_SLEEP:
+                # A SHOW with nothing written since the previous one sends the same frame again
+                if self.dirty:
+                    self.flush()
+                    self.show = True
+                    self.dirty = False
+                if op == OP_SHOW_AND_SLEEP:
+                    self.sleep(_U16.unpack_from(mv, start + 1)[0])
+            elif op == OP_MOVE_UP or op == OP_MOVE_DOWN or op == OP_MOVE_UP_WIDE or op == OP_MOVE_DOWN_WIDE:
+                # Moves read the current pixels, everything before has to be written first. The flags byte
+                # ends the instruction
+                self.flush()
+                self.out += mv[start:end]
+                self.dirty = not mv[end - 1] & 1
+            else:
+                # SECTION, REPEAT and the subroutine opcodes snapshot, restore or jump around the state
+                self.flush()
+                self.out += mv[start:end]
+                self.dirty = True
+        self.flush()
+        return bytes(self.out)
+
+
+# Rewrites a program so every SHOW still sends the same frame at the same time, with fewer instructions:
+# - writes between two SHOWs are folded to one FILL, SET or SET_MULTIPLE per pixel
+# - SET_BRIGHTNESS after a SET of the same pixel is folded into the SET
+# - consecutive SLEEPs are summed, a SHOW followed by a SLEEP becomes SHOW_AND_SLEEP
+# - speed changes that no SLEEP observes are dropped
+# - SHOWs with no writes since the previous SHOW are dropped
+def optimize(data):
+    return _Optimizer().run(data)
+
+
+def count_instructions(data):
+    return sum(1 for _ in scan(data))
+
+
+def optimize_file(path, output=None):
+    header, data = leds_file.load(path)
+    optimized = optimize(data)
+    output = output or path
+    tmp = f'{output}.tmp'
+    with open(tmp, 'wb') as fd:
+        if header is None:
+            fd.write(zlib.compress(optimized, 9))
+        else:
+            chunk_size = leds_file.CHUNK_SIZE if header.chunked else None
+            fd.write(leds_file.pack(optimized, header.num_px, analyze(optimized), chunk_size=chunk_size))
+    os.replace(tmp, output)
+    print(
+        f"{path}: {count_instructions(data)} -> {count_instructions(optimized)} instructions, "
+        f"{len(data)} -> {len(optimized)} bytes"
+    )
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Peephole optimizer for compiled .leds programs')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--output', help='output file, only with a single input file')
+    args = parser.parse_args(argv)
+    if args.output and len(args.files) > 1:
+        parser.error('--output needs a single input file')
+    for path in args.files:
+        optimize_file(path, args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,134 @@
+import os
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# An output is what the interpreter writes frames to: len(), item and slice assignment of (r, g, b) tuples,
+# fill(color) and show(), like the adafruit NeoPixel. close() releases it at shutdown
+OUTPUTS = ('neopixel', 'record')
+RECORDINGS_DIR = 'recordings'
+
+# Recordings are .npy files of (time, rgb) records. The header is padded to a fixed size so it can be
+# rewritten with the frame count without moving the frames
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+_NPY_HEADER_SIZE = 256
+_TIME = struct.Struct('<d')
+
+
+# Output discarding everything but the number of frames shown, for benchmarks and validation
+class NullOutput:
+    def __init__(self, num_px):
+        self.num_px = num_px
+        self.shows = 0
+
+    def __len__(self):
+        return self.num_px
+
+    def __setitem__(self, index, color):
+        pass
+
+    def fill(self, color):
+        pass
+
+    def show(self):
+        self.shows += 1
+
+
+# Imported here so the server starts without the Raspberry Pi libraries when no strip drives hardware
+def open_neopixel(strip):
+    import board
+    import neopixel
+    return neopixel.NeoPixel(
+        getattr(board, strip.pin), strip.num_px, brightness=strip.brightness, auto_write=False,
+        pixel_order=getattr(neopixel, strip.pixel_order)
+    )
+
+
+# Headless output writing every shown frame with its time in seconds since the recording started. Colors
+# are recorded as the interpreter sends them, before the strip brightness
+class RecordingOutput:
+    def __init__(self, num_px, path, clock=time.monotonic):
+        self.num_px = num_px
+        self.path = path
+        self.clock = clock
+        self.buffer = bytearray(3 * num_px)
+        self.frames = 0
+        self.start = clock()
+        self.fd = open(path, 'wb')
+        self.fd.write(self._header())
+
+    def __len__(self):
+        return self.num_px
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_px
+        if not 0 <= index < self.num_px:
+            raise IndexError(f"Pixel index {index} out of range")
+        return tuple(self.buffer[3 * index:3 * index + 3])
+
+    def __setitem__(self, index, color):
+        if isinstance(index, slice):
+            for i, c in zip(range(*index.indices(self.num_px)), color):
+                self[i] = c
+            return
+        if index < 0:
+            index += self.num_px
+        if not 0 <= index < self.num_px:
+            raise IndexError(f"Pixel index {index} out of range")
+        self.buffer[3 * index:3 * index + 3] = bytes((int(color[0]), int(color[1]), int(color[2])))
+
+    def fill(self, color):
+        self.buffer[:] = bytes((int(color[0]), int(color[1]), int(color[2]))) * self.num_px
+
+    def show(self):
+        self.fd.write(_TIME.pack(self.clock() - self.start))
+        self.fd.write(self.buffer)
+        self.frames += 1
+
+    def _header(self):
+        descr = [('time', '<f8'), ('rgb', '|u1', (self.num_px, 3))]
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (descr, self.frames)
+        header = header.ljust(_NPY_HEADER_SIZE - len(_NPY_MAGIC) - 3) + '\n'
+        return _NPY_MAGIC + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    # Makes the file a valid .npy of the frames recorded so far
+    def flush(self):
+        position = self.fd.tell()
+        self.fd.seek(0)
+        self.fd.write(self._header())
+        self.fd.seek(position)
+        self.fd.flush()
+
+    def close(self):
+        if not self.fd.closed:
+            self.flush()
+            self.fd.close()
+
+
+# (times, frames) of a recording, frames has a (frames, num_px, 3) shape
+def load_recording(path):
+    if np is None:
+        raise RuntimeError('Reading recordings needs numpy')
+    records = np.load(path)
+    return records['time'], records['rgb']
+
+
+# Output of a strip, kind is one of OUTPUTS. Recordings are written to directory/<strip name>.npy
+def open_output(strip, kind, directory=RECORDINGS_DIR):
+    if kind == 'neopixel':
+        return open_neopixel(strip)
+    if kind == 'record':
+        os.makedirs(directory, exist_ok=True)
+        return RecordingOutput(strip.num_px, os.path.join(directory, f'{strip.name}.npy'))
+    raise ValueError(f"Unknown output {kind!r}, expected one of {', '.join(OUTPUTS)}")
+
+
+def close_output(output):
+    close = getattr(output, 'close', None) or getattr(output, 'deinit', None)
+    if close is not None:
+        close()
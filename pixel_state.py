@@ -0,0 +1,237 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BLACK = (0, 0, 0, 0)
+
+
+# Tracks the span of pixels changed since the last show() so unchanged frames are not transmitted.
+# Outputs that implement show_span(start, stop) only get the changed span pushed
+class DirtyTracker:
+    def __init__(self, num_px):
+        self.num_px = num_px
+        self.shows = 0
+        self.shows_skipped = 0
+        self.writes = 0
+        self.writes_skipped = 0
+        self.clean()
+        self.forced = True
+
+    def clean(self):
+        self.dirty_lo = self.num_px
+        self.dirty_hi = -1
+        self.forced = False
+
+    def mark(self, lo, hi):
+        if lo < self.dirty_lo:
+            self.dirty_lo = lo
+        if hi > self.dirty_hi:
+            self.dirty_hi = hi
+
+    def stats(self):
+        return {
+            'shows': self.shows,
+            'shows_skipped': self.shows_skipped,
+            'writes': self.writes,
+            'writes_skipped': self.writes_skipped,
+        }
+
+    def transmit(self, out, lo, hi):
+        show_span = getattr(out, 'show_span', None)
+        if show_span is not None and not self.forced:
+            show_span(lo, hi)
+        else:
+            out.show()
+        self.shows += 1
+        self.clean()
+
+
+class ListPixelState(DirtyTracker):
+    def __init__(self, num_px, c2p):
+        super().__init__(num_px)
+        self.c2p = c2p
+        self.colors = [BLACK for _ in range(num_px)]
+
+    def reset(self, out=None):
+        self.colors = [BLACK for _ in range(self.num_px)]
+        if out is not None:
+            out.fill((0, 0, 0))
+        self.clean()
+        self.forced = True
+
+    def __getitem__(self, index):
+        return self.colors[index]
+
+    def __len__(self):
+        return self.num_px
+
+    def snapshot(self):
+        return self.colors.copy()
+
+    def _write(self, index, color, out):
+        if self.colors[index] == color:
+            self.writes_skipped += 1
+            return
+        self.colors[index] = color
+        if out is not None:
+            out[index] = self.c2p(color)
+            self.writes += 1
+        self.mark(index, index)
+
+    def _write_span(self, start, vector, out):
+        colors, c2p = self.colors, self.c2p
+        first = last = None
+        skipped = 0
+        for index, color in enumerate(vector, start):
+            if colors[index] == color:
+                skipped += 1
+                continue
+            colors[index] = color
+            if out is not None:
+                out[index] = c2p(color)
+            if first is None:
+                first = index
+            last = index
+        self.writes_skipped += skipped
+        if first is not None:
+            if out is not None:
+                self.writes += len(vector) - skipped
+            self.mark(first, last)
+
+    def restore(self, snapshot, out):
+        self._write_span(0, snapshot, out)
+
+    def set(self, index, color, out):
+        self._write(index, color, out)
+
+    def set_brightness(self, index, value, out):
+        self._write(index, self.colors[index][:3] + (value,), out)
+
+    def fill(self, color, out):
+        if self.colors.count(color) == self.num_px:
+            self.writes_skipped += self.num_px
+            return
+        self.colors = [color for _ in range(self.num_px)]
+        if out is not None:
+            out.fill(self.c2p(color))
+            self.writes += self.num_px
+        self.mark(0, self.num_px - 1)
+
+    def move(self, lb, ub, sp, trail, rotate, down, out):
+        vector = self.colors[lb:ub + 1]
+        if down:
+            vector = vector[sp:] + (
+                vector[:sp] if rotate else (
+                    [vector[-1] for _ in range(sp)] if trail else [BLACK for _ in range(sp)]
+                )
+            )
+        else:
+            vector = (vector[-sp:] if rotate else (
+                [vector[0] for _ in range(sp)] if trail else [BLACK for _ in range(sp)]
+            )) + vector[:max(len(vector) - sp, 0)]
+
+        self._write_span(lb, vector[:ub + 1 - lb], out)
+
+    def show(self, out):
+        if self.dirty_hi < 0 and not self.forced:
+            self.shows_skipped += 1
+            return
+        self.transmit(out, self.dirty_lo, self.dirty_hi + 1)
+
+
+# Pixel state as a (num_px, 4) uint8 array. Operations only touch the array, the changed span is converted
+# with the vectorized color pipeline and written to the output on show()
+class NumpyPixelState(DirtyTracker):
+    def __init__(self, num_px, pipeline):
+        if np is None:
+            raise RuntimeError("The numpy pixel engine requires numpy")
+        super().__init__(num_px)
+        self.pipeline = pipeline
+        self.colors = np.zeros((num_px, 4), dtype=np.uint8)
+        # What the output buffer currently holds, compared against on show() to narrow the dirty span
+        self.shown = np.zeros((num_px, 4), dtype=np.uint8)
+
+    def reset(self, out=None):
+        self.colors[:] = 0
+        self.shown[:] = 0
+        if out is not None:
+            out.fill((0, 0, 0))
+        self.clean()
+        self.forced = True
+
+    def __getitem__(self, index):
+        return tuple(self.colors[index].tolist())
+
+    def __len__(self):
+        return self.num_px
+
+    def snapshot(self):
+        return self.colors.copy()
+
+    def restore(self, snapshot, out):
+        self.colors[:] = snapshot
+        self.mark(0, self.num_px - 1)
+
+    def set(self, index, color, out):
+        self.colors[index] = color
+        self.mark(index, index)
+
+    def set_brightness(self, index, value, out):
+        self.colors[index, 3] = value
+        self.mark(index, index)
+
+    def fill(self, color, out):
+        self.colors[:] = color
+        self.mark(0, self.num_px - 1)
+
+    def move(self, lb, ub, sp, trail, rotate, down, out):
+        segment = self.colors[lb:ub + 1]
+        length = len(segment)
+        self.mark(lb, ub)
+        if rotate:
+            if sp < length:
+                segment[:] = np.roll(segment, -sp if down else sp, axis=0)
+            return
+        edge = (segment[-1] if down else segment[0]).copy() if trail else 0
+        if sp >= length:
+            segment[:] = edge
+        elif down:
+            segment[:length - sp] = segment[sp:]
+            segment[length - sp:] = edge
+        elif sp:
+            segment[sp:] = segment[:length - sp]
+            segment[:sp] = edge
+
+    def rgb(self):
+        return self.pipeline.convert(self.colors)
+
+    def show(self, out):
+        if self.forced:
+            lo, hi = 0, self.num_px
+        else:
+            lo, hi = self.dirty_lo, self.dirty_hi + 1
+            changed = np.flatnonzero((self.colors[lo:hi] != self.shown[lo:hi]).any(axis=1)) if hi > lo else ()
+            if not len(changed):
+                self.shows_skipped += 1
+                self.writes_skipped += self.num_px
+                self.clean()
+                return
+            lo, hi = lo + int(changed[0]), lo + int(changed[-1]) + 1
+        out[lo:hi] = self.pipeline.convert(self.colors[lo:hi]).tolist()
+        self.shown[lo:hi] = self.colors[lo:hi]
+        self.writes += hi - lo
+        self.writes_skipped += self.num_px - (hi - lo)
+        self.transmit(out, lo, hi)
+
+
+def default_engine():
+    return 'list' if np is None else 'numpy'
+
+
+def make_pixel_state(engine, num_px, interpretor):
+    if engine == 'numpy':
+        return NumpyPixelState(num_px, interpretor.pipeline)
+    if engine == 'list':
+        return ListPixelState(num_px, interpretor.c2p)
+    raise ValueError(f"Unknown pixel engine {engine}")
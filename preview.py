@@ -0,0 +1,102 @@
+import base64
+import threading
+import time
+
+MAX_FPS = 10
+MAX_VIEWERS = 4
+# Seconds between keep-alive comments on an idle stream
+KEEPALIVE = 15.0
+
+
+# Hands the frames shown by the interpreter to the live preview viewers. The interpreter thread only
+# stores a snapshot, at most max_fps times a second and only while somebody is watching. Frames are
+# encoded to base64 RGB by the first viewer thread that needs them and shared by all the others
+class FrameBroadcaster:
+    def __init__(self, pipeline, max_fps=MAX_FPS, max_viewers=MAX_VIEWERS, clock=time.monotonic):
+        self.pipeline = pipeline
+        self.interval = 1 / max_fps
+        self.max_viewers = max_viewers
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.viewers = 0
+        self.next_frame = 0.0
+        self.version = 0
+        self.frame = None
+        self.rgb = False
+        self.encoded_version = 0
+        self.encoded = None
+
+    def _wanted(self):
+        if not self.viewers:
+            return False
+        now = self.clock()
+        if now < self.next_frame:
+            return False
+        self.next_frame = now + self.interval
+        return True
+
+    def _publish(self, frame, rgb):
+        with self.cond:
+            self.frame = frame
+            self.rgb = rgb
+            self.version += 1
+            self.cond.notify_all()
+
+    # Called from the interpreter thread with its pixel state after a transmitted show()
+    def offer_state(self, state):
+        if self._wanted():
+            self._publish(state.snapshot(), False)
+
+    # Called with a (num_px, 3) uint8 frame from a pre-rendered timeline, which is never modified
+    def offer_rgb(self, frame):
+        if self._wanted():
+            self._publish(frame, True)
+
+    def _encode(self, frame, rgb):
+        if rgb:
+            data = frame.tobytes()
+        elif isinstance(frame, list):
+            data = bytes(min(int(channel), 255) for color in frame for channel in self.pipeline.c2p(color))
+        else:
+            data = self.pipeline.convert(frame).clip(0, 255).astype('uint8').tobytes()
+        return base64.b64encode(data).decode()
+
+    def latest(self, seen):
+        with self.cond:
+            if self.version == seen:
+                self.cond.wait(KEEPALIVE)
+            version, frame, rgb = self.version, self.frame, self.rgb
+            if version == seen or frame is None:
+                return seen, None
+            if self.encoded_version == version:
+                return version, self.encoded
+        encoded = self._encode(frame, rgb)
+        with self.cond:
+            if version > self.encoded_version:
+                self.encoded_version, self.encoded = version, encoded
+        return version, encoded
+
+    # Server-Sent Events: one "data:" line per frame, a comment line when nothing was shown for a while.
+    # Returns None when max_viewers are already watching
+    def stream(self):
+        with self.cond:
+            if self.viewers >= self.max_viewers:
+                return None
+            self.viewers += 1
+            # Send the next frame right away instead of waiting for the throttle
+            self.next_frame = 0.0
+
+        def events():
+            seen = 0
+            try:
+                while True:
+                    seen, encoded = self.latest(seen)
+                    if encoded is None:
+                        yield b': keep-alive\n\n'
+                    else:
+                        yield f'data: {encoded}\n\n'.encode()
+            finally:
+                with self.cond:
+                    self.viewers -= 1
+
+        return events()
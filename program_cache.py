@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+
+
+# A decoded animation, ready to be played by NeoPixelInterpretor.run_table or from its timeline. A chunked
+# file is kept as its leds_file.ChunkedProgram instead, and decoded a chunk at a time while it plays. A
+# program without a table is played with NeoPixelInterpretor.run(data, stream=True)
+class Program:
+    def __init__(self, name, path, data, table, timeline=None, chunks=None):
+        self.name = name
+        self.path = path
+        self.data = data
+        self.table = table
+        self.timeline = timeline
+        self.chunks = chunks
+
+    # Table to give to run_table, a new one for every play of a chunked program
+    def open_table(self):
+        if self.chunks is not None:
+            return self.chunks.open_table()
+        return self.table
+
+    def nbytes(self):
+        if self.chunks is not None:
+            return self.chunks.nbytes()
+        size = len(self.data)
+        if self.table is not None:
+            size += self.table.nbytes()
+        if self.timeline is not None:
+            size += self.timeline.frames.nbytes + self.timeline.timestamps.nbytes
+        return size
+
+
+# LRU of decoded programs keyed by content hash, bounded by their decoded size. A key is only loaded once
+# at a time, a get() for a key that another thread is loading waits for that load instead of repeating it
+class ProgramCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.sem = threading.Semaphore()
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        self.sem.acquire()
+        found = key in self.entries or key in self.loading
+        self.sem.release()
+        return found
+
+    def get(self, key, load):
+        while True:
+            self.sem.acquire()
+            program = self.entries.get(key)
+            if program is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.sem.release()
+                return program
+            pending = self.loading.get(key)
+            if pending is None:
+                self.loading[key] = threading.Event()
+                self.misses += 1
+            self.sem.release()
+            if pending is None:
+                break
+            # If that load failed the loop takes it over
+            pending.wait()
+
+        try:
+            program = load()
+            self.put(key, program)
+        finally:
+            self.sem.acquire()
+            self.loading.pop(key).set()
+            self.sem.release()
+        return program
+
+    def put(self, key, program):
+        size = program.nbytes()
+        if size > self.max_bytes:
+            return
+        self.sem.acquire()
+        if key in self.entries:
+            self.size -= self.entries.pop(key).nbytes()
+        self.entries[key] = program
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes()
+            self.evictions += 1
+        self.sem.release()
+
+    def stats(self):
+        self.sem.acquire()
+        stats = {
+            'programs': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+        self.sem.release()
+        return stats
@@ -0,0 +1,122 @@
+import os
+import threading
+from collections import deque
+
+CAPACITY = 1000
+MAX_BYTES = 5 * 1024 * 1024
+BACKUPS = 3
+FLUSH_INTERVAL = 1.0
+TAIL_CHUNK = 8192
+
+
+# Shared append-only log. Writes go through a buffered file that is flushed at most every flush_interval
+# seconds and rotated to path.1 .. path.<backups> past max_bytes. The last lines are kept in memory with
+# their byte offsets in the current file, so readers rarely touch the disk
+class RingLog:
+    def __init__(self, path, capacity=CAPACITY, max_bytes=MAX_BYTES, backups=BACKUPS, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.sem = threading.Semaphore()
+        # (start offset, end offset, line) of the most recent lines of the current file
+        self.lines = deque(maxlen=capacity)
+        self.timer = None
+        self._open()
+
+    def _open(self):
+        self.fd = open(self.path, 'ab', buffering=64 * 1024)
+        self.offset = self.fd.tell()
+        self.lines.clear()
+
+    def _rotate(self):
+        self.fd.close()
+        for generation in range(self.backups - 1, 0, -1):
+            source = f'{self.path}.{generation}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{generation + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _flush_later(self):
+        self.sem.acquire()
+        self.timer = None
+        self.fd.flush()
+        self.sem.release()
+
+    def write(self, line):
+        data = (line + '\n').encode()
+        self.sem.acquire()
+        self.fd.write(data)
+        self.lines.append((self.offset, self.offset + len(data), line))
+        self.offset += len(data)
+        if self.offset > self.max_bytes:
+            self._rotate()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.flush_interval, self._flush_later)
+            self.timer.daemon = True
+            self.timer.start()
+        self.sem.release()
+
+    def flush(self):
+        self.sem.acquire()
+        self.fd.flush()
+        self.sem.release()
+
+    def close(self):
+        self.sem.acquire()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.fd.close()
+        self.sem.release()
+
+    # The last limit lines, oldest first
+    def tail(self, limit):
+        self.sem.acquire()
+        try:
+            # The ring is enough when it holds limit lines or everything since the file was started
+            if len(self.lines) >= limit or (self.lines[0][0] if self.lines else self.offset) == 0:
+                return [line for _, _, line in list(self.lines)[-limit:]] if limit else []
+            self.fd.flush()
+            with open(self.path, 'rb') as fd:
+                pos = self.offset
+                data = b''
+                while pos > 0 and data.count(b'\n') <= limit:
+                    step = min(TAIL_CHUNK, pos)
+                    pos -= step
+                    fd.seek(pos)
+                    data = fd.read(step) + data
+            return data.decode(errors='replace').splitlines()[-limit:] if limit else []
+        finally:
+            self.sem.release()
+
+    # Up to limit lines written after byte offset since of the current file, oldest first, and the offset
+    # to continue from. An offset past the end of the file (it was rotated) restarts from its beginning
+    def read(self, since, limit):
+        self.sem.acquire()
+        try:
+            if since > self.offset:
+                since = 0
+            if self.lines and since >= self.lines[0][0]:
+                selected = [entry for entry in self.lines if entry[0] >= since][:limit]
+                return [line for _, _, line in selected], selected[-1][1] if selected else since
+            self.fd.flush()
+            lines = []
+            with open(self.path, 'rb') as fd:
+                fd.seek(max(since - 1, 0))
+                # Align to the start of a line when since points into the middle of one
+                if since and fd.read(1) != b'\n':
+                    since += len(fd.readline())
+                while len(lines) < limit and since < self.offset:
+                    raw = fd.readline()
+                    if not raw:
+                        break
+                    since += len(raw)
+                    lines.append(raw.decode(errors='replace').rstrip('\n'))
+            return lines, since
+        finally:
+            self.sem.release()
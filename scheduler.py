@@ -0,0 +1,63 @@
+import time
+from array import array
+
+
+# Sleeps target absolute deadlines on a monotonic clock, so the time spent decoding, computing pixels and
+# pushing frames is taken out of the next sleep instead of accumulating as drift. Sleeps are cut in chunk
+# second slices to poll should_stop, chunk=None sleeps in one go for a sleep that wakes up on its own when
+# stopped (threading.Event.wait)
+class DeadlineScheduler:
+    def __init__(self, clock=time.monotonic, sleep=time.sleep, max_fps=None, chunk=1.0):
+        self.clock = clock
+        self.sleep = sleep
+        self.max_fps = max_fps
+        self.chunk = chunk
+        self.start()
+
+    def start(self, origin=None):
+        self.origin = self.clock() if origin is None else origin
+        self.deadline = self.origin
+        self.last_show = None
+        # Wake-up error per sleep in seconds: positive is overshoot (late), negative is undershoot (early)
+        self.errors = array('d')
+
+    def advance(self, seconds):
+        self.deadline += seconds
+
+    # The error is taken right after the sleep meant to reach the deadline, before the loop sleeps again
+    # for what is left of an early wake-up, or on entry when the deadline has already passed
+    def wait(self, should_stop=None):
+        error = None
+        while True:
+            remaining = self.deadline - self.clock()
+            if remaining <= 0:
+                break
+            if should_stop is not None and should_stop():
+                return False
+            final = self.chunk is None or remaining <= self.chunk
+            self.sleep(remaining if final else self.chunk)
+            if final and error is None:
+                error = self.clock() - self.deadline
+        self.errors.append(self.clock() - self.deadline if error is None else error)
+        return True
+
+    def pace(self):
+        if not self.max_fps or self.last_show is None:
+            return
+        remaining = self.last_show + 1 / self.max_fps - self.clock()
+        if remaining > 0:
+            self.sleep(remaining)
+
+    def shown(self):
+        self.last_show = self.clock()
+
+    def report(self):
+        errors = self.errors
+        return {
+            'sleeps': len(errors),
+            'elapsed': self.clock() - self.origin,
+            'scheduled': self.deadline - self.origin,
+            'mean_error': sum(errors) / len(errors) if errors else 0.0,
+            'max_overshoot': max(max(errors), 0.0) if errors else 0.0,
+            'max_undershoot': max(-min(errors), 0.0) if errors else 0.0,
+        }
@@ -1,6 +1,8 @@
 #!/home/pi/becuri2/venv/bin/python
 import cherrypy
 import hashlib
+import itertools
+import json
 import os
 import random
 import re
@@ -8,42 +10,80 @@ import threading
 import time
 import zlib
 import signal
-import neopixel
-import board
-
+import struct
+import tempfile
+
+import leds_file
+import timeline
+from commands import Command, CommandChannel
+from analyzer import analyze, analyze_table
+from color_pipeline import ColorPipeline
+from metrics import Metrics
 from interpretor import NeoPixelInterpretor
-
-log_sem = threading.Semaphore()
-log_path = os.path.join(os.getcwd(), 'server.log')
+from outputs import RECORDINGS_DIR, close_output, open_output
+from pixel_state import default_engine
+from preview import FrameBroadcaster
+from program_cache import Program, ProgramCache
+from ring_log import RingLog
+from strips import StripPlayer, load_strips, run_all
+from validator import ValidatorPool, new_report
+
+server_log = RingLog(os.path.join(os.getcwd(), 'server.log'))
+LOG_PAGE = 200
+LOG_PAGE_MAX = 1000
+
+# Interpreter instrumentation served on /metrics, opt-in because it times every instruction
+metrics_enabled = os.environ.get('LEDS_METRICS', '') == '1'
+# Output backend of every strip, overriding strips.json. LEDS_OUTPUT=record runs the server without
+# hardware and records the frames of each strip to recordings/<strip name>.npy
+output_override = os.environ.get('LEDS_OUTPUT') or None
+
+# Animations longer than this are cut off, shorter ones get a little slack on top of their exact length so
+# decoding and output time never cut the last frames
+MAX_RUNTIME = 180.0
+RUNTIME_SLACK = 1.0
+
+# Decoded programs (and their timelines) kept in memory between plays
+PROGRAM_CACHE_BYTES = 64 * 1024 * 1024
+# Larger programs are cached undecoded and decoded while they play, so they start without a decode pause
+STREAM_ABOVE = 1024 * 1024
+
+# Strips start an animation together this long after it was handed to their players
+START_DELAY = 0.05
+
+# Uploads are streamed through fixed-size buffers, these bound the file and what it decompresses to. Chunked
+# files are never inflated whole, only each of their chunks is bound by DECOMPRESSED_LIMIT
+UPLOAD_LIMIT = 50 * 1024 * 1024
+DECOMPRESSED_LIMIT = 32 * 1024 * 1024
+CHUNKED_DECOMPRESSED_LIMIT = 1024 * 1024 * 1024
+UPLOAD_CHUNK = 64 * 1024
+# Worker processes decoding and mock-running uploads before they are accepted
+VALIDATION_WORKERS = 2
+
+# <user>-<md5 of the uploaded file>-<animation name>
+NAME_PATTERN = re.compile('([a-z]+)-([a-z0-9]+)-([a-zA-Z0-9 ]+)')
 
 status_sem = threading.Semaphore()
 status = ''
 
-comm_sem = threading.Semaphore()
-comm = {
-    'running': True,                # Tells the controller if it should run
-    'shutdown': False,              # Tells the controller to shutdown
-    'update': True,                # Tells the controller to refresh the animation list
-    'test': {
-        'testing': False,
-        'username': '',
-        'filename': ''
-    },
-}
-
-
 class Controller(threading.Thread):
     def __init__(self):
-        # Pixels variables
-        self.npx = 100
-        self.pixels = neopixel.NeoPixel(board.D18, self.npx, brightness=1.0, auto_write=False, pixel_order=neopixel.RGB)
+        # Strips driven by this server, see strips.json
+        self.strips = load_strips(os.path.join(os.getcwd(), 'strips.json'))
 
         # Main animations variables
         self.anims = []
         self.anim_index = 0
         self.anim_data = b''
+        self.anim_path = ''
         self.anim_offset = 0
-        self.anim_time_remaining = 180.0
+        self.anim_time_remaining = MAX_RUNTIME
+        # Static analysis of every animation file, by file name (which contains the content hash)
+        self.analyses = {}
+        # Pixel count each animation was compiled for, None for v1 files that do not record it
+        self.sizes = {}
+        self.playlist_time = 0.0
+        self.programs = ProgramCache(PROGRAM_CACHE_BYTES)
 
         # Testing animations variables
         self.test_data = b''
@@ -52,111 +92,216 @@ class Controller(threading.Thread):
         self.save_status = ''
 
         # Use interpretor v2
-        self.interpretor = NeoPixelInterpretor(self.pixels, self.npx)
-
-        # Other variables
-        self.conf = None
-        
-        self.anim_startup()
+        # Brightness curve, gamma and channel calibration of the first strip, tuned in color.json
+        self.pipeline = ColorPipeline.load(os.path.join(os.getcwd(), self.strips[0].color))
+        self.metrics = Metrics() if metrics_enabled else None
+        # Frames of the first strip streamed to the browser preview on /preview
+        self.preview = FrameBroadcaster(self.pipeline)
+        # Commands from the Site and the signal handlers, playback stops as soon as an interrupting one is queued
+        self.players = []
+        self.channel = CommandChannel(on_interrupt=self.stop_all)
+        self.paused = False
+        # One interpreter thread per strip, the first one is instrumented and previewed
+        self.players = [self.make_player(strip, index == 0) for index, strip in enumerate(self.strips)]
+        for player in self.players:
+            player.start()
+        # Play animations from pre-rendered frame timelines cached next to the animation files
+        self.use_timeline = timeline.available()
+
+        run_all(self.players, self.anim_startup)
 
         super().__init__()
 
     def run(self):
+        self.refresh_animation_list(redundant=True)
         while True:
-            global comm
-            comm_sem.acquire()
-            self.conf = comm.copy()
-            comm_sem.release()
-
-            # Are we running?
-            if not self.conf['running']:
-                time.sleep(1)
+            # Paused: sleep in the channel until a command arrives
+            command, payload = self.channel.receive() if self.paused else self.channel.poll()
+            if command is not None:
+                if not self.handle(command, payload):
+                    return
                 continue
 
-            # Check if we should shutdown
-            if self.conf['shutdown']:
-                self.interpretor.stop()
-                self.anim_shutdown()
-                return
-
-            # Check if we need to update the animation list
-            if self.conf['update']:
-                self.refresh_animation_list()
-                comm_sem.acquire()
-                comm['update'] = False
-                comm_sem.release()
-
-            # We use the filename to check if we test because we would basically init everytime we would pass here
-            if self.conf['test']['filename'] != '':
-                # Load test file
-                test_path = os.path.join(os.getcwd(), 'temp', self.conf['test']['filename'])
-                data = zlib.decompress(open(test_path, 'rb').read())
-
-                os.remove(test_path)
-
-                comm_sem.acquire()
-                username = comm['test']['username']
-                comm['test']['testing'] = True
-                comm['test']['filename'] = ''
-                self.conf = comm.copy()
-                comm_sem.release()
-
-                self.log_to_file('Now testing %s\'s animation' % username)
-                global status
-                status_sem.acquire()
-                self.save_status = status
-                status = 'Now testing: %s' % username
-                status_sem.release()
-
-                self.anim_test_start()
-                self.interpretor.run(data, test=True)
-                self.exit_testing()
-
-            self.load_new_animation()
-            self.interpretor.run(self.anim_data)
+            programs = dict(zip(self.players, self.load_new_animation()))
+            program = next(program for program in programs.values() if program is not None)
+            start_at = time.monotonic() + START_DELAY
+            results = run_all(self.players, lambda player: self.play_program(player, programs[player], start_at))
+            self.log_progress(program.name, results, 'frames' if program.timeline is not None else 'instructions')
+
+    def make_player(self, strip, primary):
+        pixels = open_output(strip, output_override or strip.output, os.path.join(os.getcwd(), RECORDINGS_DIR))
+        interpretor = NeoPixelInterpretor(
+            pixels, strip.num_px, engine=default_engine(),
+            pipeline=self.pipeline if primary else ColorPipeline.load(os.path.join(os.getcwd(), strip.color)),
+            metrics=self.metrics if primary else None, preview=self.preview if primary else None,
+            interrupted=self.channel.interrupting
+        )
+        return StripPlayer(strip, pixels, interpretor)
+
+    def stop_all(self):
+        for player in self.players:
+            player.interpretor.stop()
+
+    # Runs on the player thread, every strip is started at the same start_at on the monotonic clock
+    def play_program(self, player, program, start_at):
+        if program is None:
+            return None
+        interpretor = player.interpretor
+        interpretor.runtime = self.anim_time_remaining
+        if program.timeline is not None:
+            return interpretor.run_timeline(program.timeline, start_at=start_at)
+        if program.table is None and program.chunks is None:
+            progress = interpretor.run(program.data, start_at=start_at, stream=True)
+        else:
+            progress = interpretor.run_table(program.open_table(), start_at=start_at)
+        if self.metrics is not None:
+            self.metrics.record_run(player.config.name, interpretor.state.stats(), interpretor.scheduler.report())
+        return progress
 
     def log_to_file(self, s):
-        buf = s + '\n'
-        log_sem.acquire()
-        with open(log_path, 'a') as fd:
-            fd.write(buf)
-        log_sem.release()
+        server_log.write(s)
+
+    # Logs the strips that failed and how far an animation got when it was stopped by a command
+    def log_progress(self, name, results, unit):
+        for player, result in zip(self.players, results):
+            if isinstance(result, Exception):
+                self.log_to_file('Strip %s could not play %s: %s' % (player.config.name, name, result))
+        progress = results[0]
+        if not isinstance(progress, dict) or progress['reason'] != 'stopped':
+            return
+        analysis = self.analyses.get(name)
+        duration = ' of %.1f' % analysis.duration if analysis is not None else ''
+        self.log_to_file('Stopped %s at %.1f%s s (%d/%d %s)' % (
+            name, progress['position'], duration, progress['done'], progress['total'], unit
+        ))
+
+    # Returns False once the Controller should exit
+    def handle(self, command, payload):
+        if command == Command.SHUTDOWN:
+            self.stop_all()
+            run_all(self.players, self.anim_shutdown)
+            for player in self.players:
+                close_output(player.pixels)
+            return False
+        if command == Command.PAUSE:
+            if not self.paused:
+                self.paused = True
+                for player in self.players:
+                    player.pixels.fill((0, 0, 0))
+                    player.pixels.show()
+                self.log_to_file('Playback paused')
+        elif command == Command.RESUME:
+            if self.paused:
+                self.paused = False
+                self.log_to_file('Playback resumed')
+        elif command == Command.REFRESH:
+            self.refresh_animation_list(redundant=True)
+        elif command == Command.PLAY_TEST:
+            self.play_test(*payload)
+        # SKIP only needs the interruption of the current animation
+        return True
 
-    def interrupt(self):
-        self.interpretor.stop()
+    def play_test(self, username, filename):
+        chunks = None
+        try:
+            test_path = os.path.join(os.getcwd(), 'temp', filename)
+            try:
+                header = leds_file.read_header(test_path)
+                if header is not None and header.chunked:
+                    chunks = leds_file.ChunkedProgram(test_path)
+                    open_table = lambda player: chunks.open_table()
+                else:
+                    _, data = leds_file.load(test_path)
+                    open_table = lambda player: player.interpretor.build_stream(data)
+            except (OSError, ValueError, zlib.error, struct.error) as e:
+                self.log_to_file('Could not play test animation of %s: %s' % (username, e))
+                if os.path.exists(test_path):
+                    os.remove(test_path)
+                return
+            os.remove(test_path)
+            # A strip the animation is not compiled for stays dark, as in load_new_animation
+            players = [
+                player for player in self.players if header is None or header.num_px == player.num_px
+            ]
+            if not players:
+                self.log_to_file('%s\'s test animation fits no strip' % username)
+                return
 
-    def load_new_animation(self):
-        global comm
+            self.log_to_file('Now testing %s\'s animation' % username)
+            global status
+            status_sem.acquire()
+            self.save_status = status
+            status = 'Now testing: %s' % username
+            status_sem.release()
+
+            run_all(self.players, self.anim_test_start)
+            start_at = time.monotonic() + START_DELAY
+            results = run_all(
+                self.players,
+                lambda player: player.interpretor.run_table(
+                    open_table(player), test=True, start_at=start_at
+                ) if player in players else None
+            )
+            self.log_progress(filename, results, 'instructions')
+            self.exit_testing(username)
+        finally:
+            if chunks is not None:
+                chunks.close()
+            self.channel.finish_test()
+
+    def load_new_animation(self, skipped=0):
         # Redundancy
-        comm_sem.acquire()
-        need_update = self.anim_index == len(self.anims)
-        comm_sem.release()
-        if need_update:
+        if self.anim_index == len(self.anims):
             self.refresh_animation_list(redundant=True)
-            comm_sem.acquire()
-            comm['update'] = False
-            comm_sem.release()
 
-        # Load animation data
-        self.anim_data = zlib.decompress(open(os.path.join(os.getcwd(), 'animations', self.anims[self.anim_index]), 'rb').read())
-        print('Loading %s' % self.anims[self.anim_index])
+        # Load animation data, usually already decoded by the prefetch started for the previous animation.
+        # A strip the animation does not fit stays dark
+        name = self.anims[self.anim_index]
+        programs = []
+        for player in self.players:
+            if self.sizes.get(name) not in (None, player.num_px):
+                programs.append(None)
+                continue
+            try:
+                programs.append(self.programs.get(self.program_key(name, player), lambda: self.load_program(name, player)))
+            except (OSError, ValueError, IndexError, zlib.error) as e:
+                self.log_to_file('Strip %s cannot play %s: %s' % (player.config.name, name, e))
+                programs.append(None)
+        if not any(programs):
+            if skipped >= len(self.anims):
+                raise IndexError('No animation fits the strips')
+            self.anim_index += 1
+            return self.load_new_animation(skipped + 1)
+        program = next(program for program in programs if program is not None)
+        self.anim_path = program.path
+        self.anim_data = program.data
+        print('Loading %s' % name)
+        if self.metrics is not None:
+            self.metrics.record_program_cache(self.programs.stats())
         self.anim_offset = 0
-        self.anim_time_remaining = 180.0
+        analysis = self.analyses.get(name)
+        if analysis is None:
+            analysis = self.analyses[name] = self.analyze_program(program)
+        self.anim_time_remaining = self.plan_runtime(analysis)
 
         # Update now playing
-        pattern = re.compile('([a-z]+)-([a-z0-9]+)-([a-zA-Z0-9 ]+)')
-        p = pattern.findall(self.anims[self.anim_index])[0]
-        self.log_to_file('Now playing "%s" by %s' % (p[2], p[0]))
+        p = NAME_PATTERN.findall(name)[0]
+        self.log_to_file('Now playing "%s" by %s (%.1f s, %d frames)' % (p[2], p[0], analysis.duration, analysis.frames))
 
         status_sem.acquire()
         global status
         status = 'Now playing: "%s" by %s' % (p[2], p[0])
         status_sem.release()
         self.anim_index += 1
+        self.start_prefetch()
+        return programs
 
     def refresh_animation_list(self, redundant=False):
         dpath = os.path.join(os.getcwd(), 'animations')
         self.anims = [f for f in os.listdir(dpath) if os.path.isfile(os.path.join(dpath, f))]
+        # Timelines of deleted animations
+        timeline.prune_cache(dpath, set(self.anims))
+        self.plan_playlist(dpath)
         if len(self.anims) == 0:
             raise IndexError
         random.shuffle(self.anims)
@@ -164,13 +309,93 @@ class Controller(threading.Thread):
         if not redundant:
             self.load_new_animation()
 
-    def exit_testing(self):
-        global comm
-        comm_sem.acquire()
-        comm['test']['testing'] = False
-        username = comm['test']['username']
-        comm_sem.release()
-        self.anim_test_stop()
+    # Programs are cached per strip, their timelines depend on the strip length and colors
+    def program_key(self, name, player):
+        match = NAME_PATTERN.match(name)
+        return (match.group(2) if match else name), player.config.name
+
+    # Chunked files are memory-mapped and stay compressed until played, programs over STREAM_ABOVE are
+    # decoded while they play. Neither gets a timeline
+    def load_program(self, name, player):
+        path = os.path.join(os.getcwd(), 'animations', name)
+        header = leds_file.read_header(path)
+        if header is not None and header.chunked:
+            return Program(name, path, None, None, chunks=leds_file.ChunkedProgram(path))
+        _, data = leds_file.load(path)
+        if len(data) > STREAM_ABOVE:
+            return Program(name, path, data, None)
+        interpretor = player.interpretor
+        program = Program(name, path, data, interpretor.decode(data))
+        if self.use_timeline:
+            program.timeline = timeline.load_or_render(path, data, player.num_px, pipeline=interpretor.pipeline)
+        return program
+
+    def prefetch(self, name, players):
+        for player in players:
+            try:
+                self.programs.get(self.program_key(name, player), lambda: self.load_program(name, player))
+            except (OSError, ValueError, IndexError, zlib.error) as e:
+                self.log_to_file('Could not prefetch animation %s for strip %s: %s' % (name, player.config.name, e))
+
+    # Decodes the next playlist entry in the background while the current one plays
+    def start_prefetch(self):
+        if self.anim_index >= len(self.anims):
+            return
+        name = self.anims[self.anim_index]
+        missing = [
+            player for player in self.players
+            if self.sizes.get(name) in (None, player.num_px) and self.program_key(name, player) not in self.programs
+        ]
+        if missing:
+            threading.Thread(target=self.prefetch, args=(name, missing), daemon=True).start()
+
+    # Analysis of a program the playlist was not planned with. Chunked and streamed programs have no table, they
+    # are described by their header, only a long v1 program is decoded for it
+    def analyze_program(self, program):
+        if program.table is not None:
+            return analyze_table(program.table)
+        if program.chunks is not None:
+            return program.chunks.header.analysis()
+        header = leds_file.read_header(program.path)
+        if header is not None:
+            return header.analysis()
+        return analyze(program.data)
+
+    def plan_runtime(self, analysis):
+        if analysis.duration > MAX_RUNTIME:
+            return MAX_RUNTIME
+        return analysis.duration + RUNTIME_SLACK
+
+    # v2 files are planned from their header alone, v1 files have to be decompressed and analyzed
+    def plan_playlist(self, dpath):
+        playable = []
+        for name in self.anims:
+            try:
+                if name not in self.analyses:
+                    path = os.path.join(dpath, name)
+                    header = leds_file.read_header(path)
+                    if header is None:
+                        self.analyses[name] = analyze(leds_file.load(path)[1])
+                    elif self.strip_for(header.num_px) is None:
+                        raise ValueError('compiled for %d pixels, no strip has that size' % header.num_px)
+                    else:
+                        self.analyses[name] = header.analysis()
+                    self.sizes[name] = header.num_px if header is not None else None
+            except (OSError, ValueError, zlib.error) as e:
+                self.log_to_file('Skipping animation %s: %s' % (name, e))
+                continue
+            playable.append(name)
+        self.analyses = {name: self.analyses[name] for name in playable}
+        self.sizes = {name: self.sizes[name] for name in playable}
+        self.anims = playable
+        self.playlist_time = sum(min(analysis.duration, MAX_RUNTIME) for analysis in self.analyses.values())
+        print('Playlist: %d animations, %.1f s' % (len(self.anims), self.playlist_time))
+
+    def strip_for(self, num_px):
+        return next((strip for strip in self.strips if strip.num_px == num_px), None)
+
+    def exit_testing(self, username):
+        run_all(self.players, self.anim_test_stop)
         self.log_to_file('%s test animation done' % username)
         status_sem.acquire()
         global status
@@ -181,70 +406,80 @@ class Controller(threading.Thread):
     ##############
     # ANIMATIONS #
     ##############
-    def anim_startup(self):
-        self.pixels.fill((0, 0, 0))
-        self.pixels.show()
-
-        for i in range(self.npx):
-            self.pixels[i] = (0, 255, 0)
-            self.pixels.show()
-            time.sleep(0.5 / self.npx)
-        for i in range(self.npx, 0, -1):
-            self.pixels[i-1] = (0, 0, 0)
-            self.pixels.show()
-            time.sleep(0.5 / self.npx)
-
-        self.pixels.fill((0, 0, 0))
-        self.pixels.show()
-
-    def anim_shutdown(self):
+    # Each of these runs on the player thread of one strip, run_all plays them on every strip at once
+    def anim_startup(self, player):
+        pixels, npx = player.pixels, player.num_px
+        pixels.fill((0, 0, 0))
+        pixels.show()
+
+        for i in range(npx):
+            pixels[i] = (0, 255, 0)
+            pixels.show()
+            time.sleep(0.5 / npx)
+        for i in range(npx, 0, -1):
+            pixels[i-1] = (0, 0, 0)
+            pixels.show()
+            time.sleep(0.5 / npx)
+
+        pixels.fill((0, 0, 0))
+        pixels.show()
+
+    def anim_shutdown(self, player):
+        pixels = player.pixels
         for _ in range(5):
-            self.pixels.fill((255, 0, 0))
-            self.pixels.show()
+            pixels.fill((255, 0, 0))
+            pixels.show()
             time.sleep(0.2)
-            self.pixels.fill((0, 0, 0))
-            self.pixels.show()
+            pixels.fill((0, 0, 0))
+            pixels.show()
             time.sleep(0.2)
 
-    def anim_test_start(self):
-        for i in range(self.npx):
-            self.pixels.fill((0, 0, 0))
-            self.pixels[i] = (0, 255, 0)
-            self.pixels.show()
-            time.sleep(0.25 / self.npx)
-        self.pixels.fill((0, 0, 0))
-        self.pixels.show()
-
-    def anim_test_stop(self):
-        for i in reversed(range(self.npx)):
-            self.pixels.fill((0, 0, 0))
-            self.pixels[i] = (255, 0, 0)
-            self.pixels.show()
-            time.sleep(0.25 / self.npx)
-        self.pixels.fill((0, 0, 0))
-        self.pixels.show()
+    def anim_test_start(self, player):
+        pixels, npx = player.pixels, player.num_px
+        for i in range(npx):
+            pixels.fill((0, 0, 0))
+            pixels[i] = (0, 255, 0)
+            pixels.show()
+            time.sleep(0.25 / npx)
+        pixels.fill((0, 0, 0))
+        pixels.show()
+
+    def anim_test_stop(self, player):
+        pixels, npx = player.pixels, player.num_px
+        for i in reversed(range(npx)):
+            pixels.fill((0, 0, 0))
+            pixels[i] = (255, 0, 0)
+            pixels.show()
+            time.sleep(0.25 / npx)
+        pixels.fill((0, 0, 0))
+        pixels.show()
 
 
 class Site(object):
     def __init__(self, controller):
         self.files = {}
         self.controller = controller
+        self.validator = ValidatorPool(VALIDATION_WORKERS, max_length=DECOMPRESSED_LIMIT)
         self.update_files()
 
     def update_files(self):
         dpath = os.path.join(os.getcwd(), 'animations')
         files = [f for f in os.listdir(dpath) if os.path.isfile(os.path.join(dpath, f))]
         self.files = {}
-        pattern = re.compile('([a-z]+)-([a-z0-9]+)-([a-zA-Z0-9 ]+)')
         self.files = {}
         for f in files:
-            p = pattern.findall(f)[0]
+            p = NAME_PATTERN.findall(f)[0]
             user = p[0]
             if 'test' not in self.files:
                 self.files['test'] = []
             md5 = p[1]
             fname = p[2]
-            self.files['test'].append((md5, fname))
+            # Duration from the v2 header, unknown for v1 files
+            try:
+                header = leds_file.read_header(os.path.join(dpath, f))
+            except (OSError, ValueError):
+                header = None
+            self.files['test'].append((md5, fname, header.duration if header is not None else None))
         print(self.files)
 
     @cherrypy.expose
@@ -271,11 +506,18 @@ class Site(object):
 """
         body += """
         <p>{0}</p>
+        <form action="control" method="POST">
+            <button type="submit" name="action" value="pause">Pause</button>
+            <button type="submit" name="action" value="resume">Resume</button>
+            <button type="submit" name="action" value="skip">Skip</button>
+            <button type="submit" name="action" value="refresh">Refresh</button>
+        </form>
 """.format(np)
         body += """
         <table style="width:50%">
             <tr>
                 <th>Name</th>
+                <th>Duration</th>
                 <th>Delete</th>
             </tr>
 """
@@ -284,12 +526,13 @@ class Site(object):
                 body += """
             <tr>
                 <th>{0}</th>
+                <th>{2}</th>
                 <th><form action="deleteanim" method="POST">
                     <input type="hidden" name="md5" value="{1}" />
                     <button type="submit">Delete</button>
                 </form></th>
             </tr>
-""".format(f[1], f[0])
+""".format(f[1], f[0], '%.1f s' % f[2] if f[2] is not None else '?')
 
 
         body += """
@@ -308,6 +551,23 @@ class Site(object):
             <input type="hidden" name="mode" value="test" />
             <button type="submit">Submit</button>
         </form>
+        <p>Live preview:</p>
+        <canvas id="preview" width="500" height="20"></canvas>
+        <script>
+            var canvas = document.getElementById('preview');
+            var context = canvas.getContext('2d');
+            var source = new EventSource('preview');
+            source.onmessage = function (event) {
+                var frame = atob(event.data);
+                var count = frame.length / 3;
+                var width = canvas.width / count;
+                for (var i = 0; i < count; i++) {
+                    context.fillStyle = 'rgb(' + frame.charCodeAt(3 * i) + ',' + frame.charCodeAt(3 * i + 1) + ','
+                        + frame.charCodeAt(3 * i + 2) + ')';
+                    context.fillRect(Math.floor(i * width), 0, Math.ceil(width), canvas.height);
+                }
+            };
+        </script>
         <p>Log:</p>
         <iframe src="log" height="600" width="500"></iframe>
     </body>
@@ -325,66 +585,165 @@ class Site(object):
                 name = '%s-%s-%s' % ('test', f[0], f[1])
                 self.log_to_file('%s deleted an animation: %s' % ('test', f[1]))
                 break
-        os.remove(os.path.join(os.getcwd(), 'animations', name))
+        path = os.path.join(os.getcwd(), 'animations', name)
+        os.remove(path)
+        timeline.remove_cached(path)
         self.update_files()
-
-        global comm
-        comm_sem.acquire()
-        comm['update'] = True
-        comm_sem.release()
+        self.controller.channel.send(Command.REFRESH)
 
         raise cherrypy.HTTPRedirect('/') # TODO: update redirect target
 
     def log_to_file(self, s):
-        buf = s + '\n'
-        log_sem.acquire()
-        with open(log_path, 'a') as fd:
-            fd.write(buf)
-        log_sem.release()
-
+        server_log.write(s)
+
+    # v2 files are rejected from their header alone when they are compiled for another strip size or their
+    # program is too large
+    def check_header(self, header):
+        limit = CHUNKED_DECOMPRESSED_LIMIT if header.chunked else DECOMPRESSED_LIMIT
+        if header.length > limit:
+            raise ValueError('Upload decompresses to more than %d bytes' % limit)
+        if self.controller.strip_for(header.num_px) is None:
+            raise ValueError('Animation is compiled for %d pixels, the strips have %s' % (
+                header.num_px, ', '.join(str(strip.num_px) for strip in self.controller.strips)
+            ))
+
+    # Streams the upload to a temporary file while hashing it and checking that it is a zlib stream that
+    # decompresses to at most DECOMPRESSED_LIMIT bytes, then renames it into place. The program of a v2 file
+    # is also checked against the length and checksum in its header, chunk by chunk for a chunked file.
+    # The program is then validated by a worker process. Returns the file name, empty for a rejected upload,
+    # and the validation report
     def writefile(self, file, out_dir, animname):
-        data = b''
+        digest = hashlib.md5()
+        inflater = zlib.decompressobj()
         size = 0
-        while True:
-            d = file.file.read(8192)
-            size += len(d)
-            data += d
-            if size > 50*1024*1024: # 50MB limit
-                break # TODO: implement error handling
-            if not d:
-                break
-        # Check if valid zlib
+        decompressed = 0
+        checksum = 0
+        fd, tmp_path = tempfile.mkstemp(prefix='.upload-', dir=os.path.join(os.getcwd(), 'temp'))
         try:
-            zlib.decompress(data)
-        except:
-            return ''
-
-        filename = '%s-%s' % ('test', hashlib.md5(data).hexdigest())
+            with os.fdopen(fd, 'wb') as out:
+                head = file.file.read(leds_file.HEADER_SIZE)
+                header = leds_file.parse_header(head)
+                if header is not None:
+                    self.check_header(header)
+                    if header.chunked:
+                        inflater = None
+                    size += len(head)
+                    digest.update(head)
+                    out.write(head)
+                    head = b''
+                for d in itertools.chain((head,), iter(lambda: file.file.read(UPLOAD_CHUNK), b'')):
+                    size += len(d)
+                    if size > UPLOAD_LIMIT:
+                        raise ValueError('Upload exceeds %d bytes' % UPLOAD_LIMIT)
+                    digest.update(d)
+                    out.write(d)
+                    # Whatever follows the end of the zlib stream is kept but not inflated
+                    while d and inflater is not None and not inflater.eof:
+                        chunk = inflater.decompress(d, UPLOAD_CHUNK)
+                        decompressed += len(chunk)
+                        if decompressed > DECOMPRESSED_LIMIT:
+                            raise ValueError('Upload decompresses to more than %d bytes' % DECOMPRESSED_LIMIT)
+                        checksum = zlib.crc32(chunk, checksum)
+                        d = inflater.unconsumed_tail
+            if inflater is None:
+                chunks = leds_file.ChunkedProgram(tmp_path, max_chunk=DECOMPRESSED_LIMIT)
+                try:
+                    chunks.verify()
+                finally:
+                    chunks.close()
+            elif not inflater.eof:
+                raise ValueError('Incomplete or truncated zlib stream')
+            elif header is not None and (decompressed != header.length or checksum != header.checksum):
+                raise ValueError('Program does not match the checksum in its header')
+            # v1 files play on every strip
+            report = self.validator.validate(tmp_path, min(strip.num_px for strip in self.controller.strips))
+        except (ValueError, zlib.error) as e:
+            os.remove(tmp_path)
+            self.log_to_file('Rejected upload: %s' % e)
+            return '', new_report(errors=[str(e)])
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if not report['ok']:
+            os.remove(tmp_path)
+            self.log_to_file('Rejected upload: %s' % '; '.join(report['errors']))
+            return '', report
+
+        filename = '%s-%s' % ('test', digest.hexdigest())
         path = os.path.join(os.getcwd(), out_dir, filename)
         if animname != '':
             path += '-' + animname
-        with open(path, 'wb') as out:
-            out.write(data)
+        if os.path.exists(path):
+            timeline.remove_cached(path)
+        os.replace(tmp_path, path)
         self.update_files()
-        return filename
+        return filename, report
+
+    def rejected(self, report):
+        cherrypy.response.status = 400
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(report)
 
     @cherrypy.expose
-    def log(self):
-        log_sem.acquire()
-        with open(log_path, 'r') as fd:
-            log_lines = fd.readlines()
-        log_sem.release()
+    def log(self, since=None, limit=LOG_PAGE):
+        try:
+            limit = min(max(int(limit), 0), LOG_PAGE_MAX)
+            since = None if since is None else max(int(since), 0)
+        except ValueError:
+            cherrypy.response.status = 400
+            return 'since and limit must be integers'
+
+        # Polling API: lines after byte offset since, oldest first, and the offset to ask for next
+        if since is not None:
+            lines, offset = server_log.read(since, limit)
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return json.dumps({'lines': lines, 'next': offset})
 
         buf = ''
         buf += '<pre>'
-        buf += ''.join(reversed(log_lines))
+        buf += ''.join(line + '\n' for line in reversed(server_log.tail(limit)))
         buf += '</pre>'
         return buf
 
     @cherrypy.expose
-    def uploadfile(self, name, file, mode):
-        global comm
+    def metrics(self, format='text'):
+        metrics = self.controller.metrics
+        if metrics is None:
+            cherrypy.response.status = 404
+            return 'Metrics are disabled, start the server with LEDS_METRICS=1'
+        if format == 'json':
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return json.dumps(metrics.snapshot())
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        return metrics.to_text()
+
+    @cherrypy.expose
+    def control(self, action):
+        commands = {
+            'pause': Command.PAUSE,
+            'resume': Command.RESUME,
+            'skip': Command.SKIP,
+            'refresh': Command.REFRESH,
+        }
+        if action not in commands:
+            return 'Invalid action!'
+        self.controller.channel.send(commands[action])
+        self.log_to_file('%s sent %s' % ('test', action))
+        raise cherrypy.HTTPRedirect('/') # TODO: update redirect target
+
+    @cherrypy.expose
+    def preview(self):
+        events = self.controller.preview.stream()
+        if events is None:
+            cherrypy.response.status = 503
+            return 'Too many preview viewers, try again later'
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return events
+    preview._cp_config = {'response.stream': True}
 
+    @cherrypy.expose
+    def uploadfile(self, name, file, mode):
         if len(name) == 0:
             return 'Parameter name cannot be empty'
         for c in name:
@@ -394,46 +753,41 @@ class Site(object):
             return 'Invalid file!'
 
         if mode == 'test':
-            somebody_testing = False
-            comm_sem.acquire()
-            if comm['test']['testing'] or comm['test']['filename'] != '':
-                somebody_testing = True
-            comm_sem.release()
-            if somebody_testing:
-                return '%s is testing right now...' % comm['test']['username']
-
-            filename = self.writefile(file, 'temp', '')
+            channel = self.controller.channel
+            tester = channel.testing()
+            if tester is not None:
+                return '%s is testing right now...' % tester
+
+            filename, report = self.writefile(file, 'temp', '')
             if filename == '':
-                return 'Invalid file!'
+                return self.rejected(report)
 
-            comm_sem.acquire()
-            comm['test']['username'] = 'test'
-            comm['test']['filename'] = filename
-            self.controller.interrupt()
-            comm_sem.release()
+            # Somebody else may have started a test while this upload was written
+            tester = channel.start_test('test', filename)
+            if tester is not None:
+                os.remove(os.path.join(os.getcwd(), 'temp', filename))
+                return '%s is testing right now...' % tester
         elif mode == 'animation':
-            self.writefile(file, 'animations', name[:20])
+            filename, report = self.writefile(file, 'animations', name[:20])
+            if filename == '':
+                return self.rejected(report)
             self.log_to_file('%s added a new animation: %s' % ('test', name[:20]))
         else:
             return "Invalid mode!"
         raise cherrypy.HTTPRedirect('/') # TODO: update redirect target
 
 
-controller = Controller()
-
-
 def exit_gracefully(signum, frame):
-    global comm
     global controller
-    comm_sem.acquire()
-    comm['shutdown'] = True
-    comm_sem.release()
-    controller.interrupt()
+    controller.channel.send(Command.SHUTDOWN)
+    server_log.flush()
     print('Shutting down...')
     cherrypy.engine.exit()
 
 
+# Only as __main__: the upload validation workers import this module too
 if __name__ == "__main__":
+    controller = Controller()
     signal.signal(signal.SIGINT, exit_gracefully)
     signal.signal(signal.SIGTERM, exit_gracefully)
     config = {
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+DEFAULT_PIN = 'D18'
+DEFAULT_NUM_PX = 100
+
+
+# One strip driven by the server: its data pin, length, color calibration file and output backend (see
+# outputs.OUTPUTS)
+class StripConfig:
+    def __init__(self, name, num_px=DEFAULT_NUM_PX, pin=DEFAULT_PIN, pixel_order='RGB', brightness=1.0,
+                 color='color.json', output='neopixel'):
+        self.name = name
+        self.num_px = num_px
+        self.pin = pin
+        self.pixel_order = pixel_order
+        self.brightness = brightness
+        self.color = color
+        self.output = output
+
+    def __repr__(self):
+        return f'StripConfig({self.name!r}, {self.num_px}px on {self.pin})'
+
+
+# strips.json holds a list of strips, for example
+# [{"name": "tree", "num_px": 100, "pin": "D18"}, {"name": "star", "num_px": 30, "pin": "D21"}]
+# Without the file the server drives a single 100 pixel strip on D18
+def load_strips(path):
+    if not os.path.isfile(path):
+        return [StripConfig('main')]
+    with open(path, 'r') as fd:
+        conf = json.load(fd)
+    strips = [StripConfig(**strip) for strip in conf]
+    if not strips:
+        raise ValueError(f'{path} does not define any strip')
+    if len({strip.name for strip in strips}) != len(strips):
+        raise ValueError(f'Strip names in {path} are not unique')
+    return strips
+
+
+# Thread running the jobs of one strip. A job is called with the player and its result (or the exception it
+# raised) is returned by wait(). Players are started together and waited on together, so one strip never
+# runs ahead of the others by more than one animation
+class StripPlayer(threading.Thread):
+    def __init__(self, config, pixels, interpretor):
+        super().__init__(name=f'strip-{config.name}', daemon=True)
+        self.config = config
+        self.pixels = pixels
+        self.num_px = config.num_px
+        self.interpretor = interpretor
+        self.cond = threading.Condition()
+        self.job = None
+        self.done = True
+        self.result = None
+
+    def submit(self, job):
+        with self.cond:
+            self.job = job
+            self.done = False
+            self.result = None
+            self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.done)
+            return self.result
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.job is not None)
+                job, self.job = self.job, None
+            try:
+                result = job(self)
+            except Exception as e:
+                result = e
+            with self.cond:
+                self.result = result
+                self.done = True
+                self.cond.notify_all()
+
+
+# Runs job on every player at once and returns their results in order
+def run_all(players, job):
+    for player in players:
+        player.submit(job)
+    return [player.wait() for player in players]
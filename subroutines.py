@@ -0,0 +1,86 @@
+from decoder import scan, OP_SECTION, OP_REPEAT, OP_DEFINE, OP_CALL, OP_RETURN
+
+CALL_SIZE = 3
+# DEFINE header plus the closing RETURN
+DEFINE_SIZE = 4
+MAX_SUBROUTINES = 0x10000
+
+
+# Complete SECTION ... REPEAT blocks as (start, end) byte offsets, keyed by start
+def sections(data):
+    spans = {}
+    stack = []
+    for start, op, end in scan(data):
+        if op == OP_SECTION:
+            stack.append(start)
+        elif op == OP_REPEAT and stack:
+            spans[stack.pop()] = end
+        elif op in (OP_DEFINE, OP_CALL, OP_RETURN):
+            raise ValueError("Program already uses subroutines")
+    return spans
+
+
+class _Emitter:
+    def __init__(self, data, spans, ids):
+        self.data = data
+        self.blocks = {start: bytes(data[start:end]) for start, end in spans.items()}
+        self.ends = {start: end for start, _, end in scan(data)}
+        self.ids = ids
+        self.calls = {}
+
+    def emit(self, lo, hi, out, inline_first=False):
+        data, blocks, ends, ids, calls = self.data, self.blocks, self.ends, self.ids, self.calls
+        k = lo
+        while k < hi:
+            block = blocks.get(k)
+            if block is not None and not (inline_first and k == lo):
+                routine = ids.get(block)
+                if routine is not None:
+                    out.append(OP_CALL)
+                    out += routine.to_bytes(2, byteorder='big')
+                    calls[block] = calls.get(block, 0) + 1
+                    k += len(block)
+                    continue
+            end = ends[k]
+            out += data[k:end]
+            k = end
+        return out
+
+    def program(self, blocks):
+        self.calls = {}
+        out = bytearray()
+        for block, start in blocks:
+            out.append(OP_DEFINE)
+            out += self.ids[block].to_bytes(2, byteorder='big')
+            self.emit(start, start + len(block), out, inline_first=True)
+            out.append(OP_RETURN)
+        return self.emit(0, len(self.data), out)
+
+
+# Replaces sections that occur more than once with CALLs to a shared subroutine. Subroutines are defined
+# at the start of the program, shortest first so that a body only calls subroutines defined before it
+def deduplicate(data):
+    emitter = _Emitter(data, sections(data), {})
+    first = {}
+    count = {}
+    for start, block in emitter.blocks.items():
+        first.setdefault(block, start)
+        count[block] = count.get(block, 0) + 1
+
+    candidates = {
+        block for block, n in count.items()
+        if n > 1 and (n - 1) * len(block) > n * CALL_SIZE + DEFINE_SIZE
+    }
+    while True:
+        blocks = sorted(candidates, key=lambda block: (len(block), first[block]))[:MAX_SUBROUTINES]
+        emitter.ids = {block: routine for routine, block in enumerate(blocks)}
+        out = emitter.program([(block, first[block]) for block in blocks])
+        # Blocks nested in a deduplicated section may end up called from a single place, inline those again
+        unused = {block for block in blocks if emitter.calls.get(block, 0) < 2}
+        if not unused:
+            break
+        candidates -= unused
+
+    if len(out) >= len(data):
+        return bytes(data)
+    return bytes(out)
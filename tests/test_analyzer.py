@@ -0,0 +1,88 @@
+import zlib
+
+import pytest
+
+import leds_file
+from analyzer import analyze
+from interpretor import NeoPixelInterpretor
+from neopixel2 import Neopixel
+from outputs import NullOutput
+from timeline import VirtualClock
+
+NUM_PX = 20
+
+
+def compile_program(path, body):
+    pixels = Neopixel(NUM_PX, str(path))
+    body(pixels)
+    pixels.save()
+    return leds_file.load(str(path))
+
+
+def play(data):
+    clock = VirtualClock()
+    interpretor = NeoPixelInterpretor(NullOutput(NUM_PX), NUM_PX, runtime=3600, clock=clock.time, sleep=clock.sleep)
+    progress = interpretor.run(data)
+    assert progress['reason'] == 'finished'
+    return clock.time()
+
+
+def speed_changes(pixels):
+    pixels.set_multiplier(0.5)
+    pixels[0] = (255, 0, 0)
+    pixels.show(0.4)
+    pixels[1] = (0, 255, 0)
+    pixels.show(0.4)
+    pixels.reset_speed()
+    pixels.sleep(0.25)
+
+
+def nested_speeds(pixels):
+    with pixels.section_repeat(3):
+        pixels.decelerate(0.5)
+        for i in range(4):
+            pixels[i] = (i, 10, 20)
+            pixels.show(0.05)
+        with pixels.section_repeat(2):
+            pixels.accelerate(0.7)
+            pixels.move_up(1, show=True)
+            pixels.sleep(0.1)
+        pixels.show(0.2)
+    pixels.set_multiplier(2)
+    pixels.fill((0, 0, 0))
+    pixels.show(0.3)
+
+
+def repeated_subroutines(pixels):
+    for _ in range(3):
+        pixels.set_multiplier(1.5)
+        with pixels.section_repeat(2):
+            for i in range(6):
+                pixels[i] = (50, 50, i)
+                pixels.show(0.02)
+        pixels.reset_speed()
+        pixels.show(0.1)
+
+
+@pytest.mark.parametrize('body', [speed_changes, nested_speeds, repeated_subroutines])
+def test_duration_matches_playback(tmp_path, body):
+    header, data = compile_program(tmp_path / 'program.leds', body)
+    analysis = analyze(data)
+    assert analysis.duration == pytest.approx(play(data))
+    assert header.duration == pytest.approx(analysis.duration, abs=0.001)
+
+
+def test_sleeps_are_compiled_with_the_multiplier(tmp_path):
+    _, data = compile_program(tmp_path / 'program.leds', speed_changes)
+    assert analyze(data).duration == pytest.approx(0.2 + 0.2 + 0.25)
+
+
+# Files like this one can be on disk from before uploads were validated, the playlist skips them on the
+# ValueError
+def test_truncated_v1_program_raises_value_error(tmp_path):
+    path = tmp_path / 'truncated.leds'
+    path.write_bytes(zlib.compress(bytes([6, 1, 3])))
+    header, data = leds_file.load(str(path))
+    assert header is None
+    with pytest.raises(ValueError, match='Truncated operand'):
+        analyze(data)
@@ -0,0 +1,30 @@
+import ast
+import os
+
+import compile
+
+ROOT = os.path.dirname(os.path.abspath(compile.__file__))
+
+
+def imported_modules(name):
+    with open(os.path.join(ROOT, f"{name}.py")) as fd:
+        tree = ast.parse(fd.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            yield from (alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            yield node.module.split('.')[0]
+
+
+def test_compiler_modules_include_their_imports():
+    for name in compile.COMPILER_MODULES:
+        for module in imported_modules(name):
+            if os.path.isfile(os.path.join(ROOT, f"{module}.py")):
+                assert module in compile.COMPILER_MODULES, f"{name} imports {module}"
+
+
+def test_compiler_version_changes_with_colors(monkeypatch):
+    version = compile.compiler_version()
+    hash_file = compile._hash_file
+    monkeypatch.setattr(compile, '_hash_file', lambda path: 'changed' if path.endswith('colors.py') else hash_file(path))
+    assert compile.compiler_version() != version
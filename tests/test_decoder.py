@@ -0,0 +1,33 @@
+import pytest
+
+from decoder import decode, scan, StreamTable, SIZES, OP_SET_MULTIPLE, OP_SET_MULTIPLE_WIDE, OP_SHOW
+
+# A SHOW in front, so the truncated instruction starts at offset 1
+PREFIX = bytes([OP_SHOW])
+
+TRUNCATED = [
+    PREFIX + bytes([op]) + bytes(size - 2) for op, size in sorted(SIZES.items()) if size > 1
+] + [
+    PREFIX + bytes([OP_SET_MULTIPLE]),
+    PREFIX + bytes([OP_SET_MULTIPLE, 2]) + bytes(7),
+    PREFIX + bytes([OP_SET_MULTIPLE_WIDE, 0]),
+    PREFIX + bytes([OP_SET_MULTIPLE_WIDE, 0, 1]) + bytes(5),
+]
+
+
+@pytest.mark.parametrize('data', TRUNCATED, ids=lambda data: data.hex())
+def test_truncated_operand_raises_value_error(data):
+    with pytest.raises(ValueError, match='Truncated operand at offset 1'):
+        decode(data)
+    with pytest.raises(ValueError, match='Truncated operand at offset 1'):
+        list(scan(data))
+    with pytest.raises(ValueError, match='Truncated operand at offset 1'):
+        table = StreamTable(data, window=1)
+        while table is not None:
+            table = table.following()
+
+
+def test_truncated_v1_program():
+    # SECTION then a REPEAT missing the last byte of its count
+    with pytest.raises(ValueError, match='Truncated operand at offset 1'):
+        decode(bytes([6, 7, 3]))
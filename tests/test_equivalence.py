@@ -0,0 +1,191 @@
+import contextlib
+import io
+import random
+
+import pytest
+
+import colors
+import leds_file
+from analyzer import analyze
+from decoder import StreamTable, OP_SECTION
+from interpretor import NeoPixelInterpretor
+from neopixel2 import Neopixel
+from optimizer import optimize
+from subroutines import deduplicate
+from timeline import FrameRecorder, VirtualClock
+
+NUM_PX = 30
+SEEDS = range(6)
+
+
+def random_program(pixels, seed):
+    rnd = random.Random(seed)
+    depth = 0
+    for _ in range(400):
+        r = rnd.random()
+        color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), rnd.randrange(101))
+        if r < 0.25:
+            pixels[rnd.randrange(NUM_PX)] = color
+        elif r < 0.3:
+            pixels.fill(color)
+        elif r < 0.42:
+            pixels.show(rnd.choice([None, 0.02, 0.3, 0.7]))
+        elif r < 0.47:
+            pixels.sleep(rnd.choice([0.0, 0.02, 0.5, 1.2]))
+        elif r < 0.55:
+            lower = rnd.randrange(NUM_PX - 2)
+            upper = rnd.randrange(lower + 1, NUM_PX)
+            mode = rnd.randrange(3)
+            move = pixels.move_up if rnd.random() < 0.5 else pixels.move_down
+            move(rnd.randrange(1, upper - lower + 1), lower, upper, trail=mode == 1, rotate=mode == 2,
+                 show=rnd.random() < 0.5)
+        elif r < 0.58:
+            pixels.set_gradient([color, colors.GREEN, colors.BLUE], 0, NUM_PX - 1)
+        elif r < 0.65 and depth < 3:
+            pixels.section()
+            depth += 1
+        elif r < 0.72 and depth > 0:
+            pixels.repeat(rnd.randrange(1, 4))
+            depth -= 1
+        elif r < 0.76:
+            pixels.set_multiplier(rnd.choice([0.5, 1, 1.5, 2]))
+        elif r < 0.79:
+            pixels.accelerate(0.1) if pixels.get_speed() < 5 else pixels.reset_speed()
+        elif r < 0.81:
+            pixels.decelerate(0.2)
+        elif r < 0.83:
+            pixels.reset_speed()
+        elif r < 0.9:
+            pixels.set_brightness(rnd.randrange(NUM_PX), rnd.randrange(101))
+    while depth:
+        pixels.repeat(2)
+        depth -= 1
+
+
+# Repeated blocks, so deduplicate has subroutines to extract, some of them changing the speed
+def motifs_program(pixels, seed):
+    rnd = random.Random(seed)
+
+    def motif(k):
+        with pixels.section_repeat(2 + k % 2):
+            pixels[k % NUM_PX] = colors.RED
+            pixels.move_up(1, 0, NUM_PX - 1, rotate=True)
+            pixels.show(0.05)
+            if k % 3 == 0:
+                with pixels.section_repeat(2):
+                    pixels.set_gradient([colors.BLUE, colors.GREEN], 0, NUM_PX - 1)
+                    pixels.accelerate(0.1)
+                    pixels.set_brightness(k, 30 + k)
+                    pixels.show(0.1)
+
+    for _ in range(60):
+        r = rnd.random()
+        if r < 0.5:
+            motif(rnd.randrange(6))
+        elif r < 0.7:
+            pixels[rnd.randrange(NUM_PX)] = colors.CYAN
+            pixels.show(0.2)
+        elif r < 0.8:
+            pixels.set_multiplier(rnd.choice([0.5, 1, 2]))
+        else:
+            with pixels.section_repeat(2):
+                motif(rnd.randrange(6))
+                pixels.sleep(0.1)
+
+
+# Writes that are overwritten or never shown, for the optimizer to remove
+def wasteful_program(pixels, seed):
+    rnd = random.Random(seed)
+    for _ in range(200):
+        if rnd.random() < 0.3:
+            pixels.fill(colors.BLACK)
+        for _ in range(rnd.randrange(8)):
+            pixels[rnd.randrange(NUM_PX)] = (rnd.randrange(256), 0, rnd.randrange(256), rnd.randrange(101))
+        if rnd.random() < 0.3:
+            pixels.set_brightness(rnd.randrange(NUM_PX), rnd.randrange(101))
+        if rnd.random() < 0.2:
+            pixels.move_down(1, 0, NUM_PX - 1, rotate=True, show=rnd.random() < 0.5)
+        if rnd.random() < 0.2:
+            pixels.set_multiplier(rnd.choice([0.5, 1, 2]))
+        if rnd.random() < 0.1:
+            pixels.sleep(0.05)
+        pixels.show(rnd.choice([None, 0.01, 0.1]))
+        if rnd.random() < 0.3:
+            pixels.show()
+
+
+PROGRAMS = [random_program, motifs_program, wasteful_program]
+
+
+def compile_program(tmp_path, body, seed):
+    pixels = Neopixel(NUM_PX, str(tmp_path / 'plain.leds'), optimize=False, subroutines=False)
+    body(pixels, seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pixels.save()
+    return bytes(pixels.data)
+
+
+# (time, pixels) of every change of what the strip shows, and the time the program ends
+def trace(play):
+    clock = VirtualClock()
+    recorder = FrameRecorder(NUM_PX, clock)
+    interpretor = NeoPixelInterpretor(recorder, NUM_PX, runtime=1e9, clock=clock.time, sleep=clock.sleep)
+    progress = play(interpretor)
+    assert progress['reason'] == 'finished'
+    frames = []
+    for timestamp, frame in zip(recorder.timestamps, recorder.frames):
+        if not frames or frames[-1][1] != frame:
+            frames.append((round(timestamp, 6), frame))
+    return frames, round(clock.time(), 6)
+
+
+def play_data(data):
+    return lambda interpretor: interpretor.run(data)
+
+
+def play_stream(data, window):
+    return lambda interpretor: interpretor.run_table(StreamTable(data, window=window, prefix=(OP_SECTION,)))
+
+
+@contextlib.contextmanager
+def chunked(tmp_path, data, chunk_size):
+    path = tmp_path / 'chunked.leds'
+    path.write_bytes(leds_file.pack(data, NUM_PX, analyze(data), chunk_size=chunk_size))
+    program = leds_file.ChunkedProgram(str(path))
+    try:
+        yield program
+    finally:
+        program.close()
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('body', PROGRAMS)
+def test_transformed_programs_play_the_same_frames(tmp_path, body, seed):
+    plain = compile_program(tmp_path, body, seed)
+    expected = trace(play_data(plain))
+    assert expected[0]
+
+    optimized = optimize(plain)
+    assert trace(play_data(optimized)) == expected
+    assert trace(play_data(deduplicate(plain))) == expected
+    saved = deduplicate(optimized)
+    assert trace(play_data(saved)) == expected
+
+    for window in (1, 7, 256):
+        assert trace(play_stream(saved, window)) == expected
+    assert trace(lambda interpretor: interpretor.run(saved, stream=True)) == expected
+
+    for chunk_size in (64, 1024):
+        with chunked(tmp_path, saved, chunk_size) as program:
+            assert trace(lambda interpretor: interpretor.run_table(program.open_table())) == expected
+
+
+@pytest.mark.parametrize('body', PROGRAMS)
+def test_analysis_matches_the_trace(tmp_path, body):
+    plain = compile_program(tmp_path, body, 0)
+    frames, end = trace(play_data(plain))
+    for data in (plain, deduplicate(optimize(plain))):
+        analysis = analyze(data)
+        assert analysis.duration == pytest.approx(end)
+        # The trace keeps the shows that change a pixel, the analysis counts the ones after any write
+        assert analysis.frames >= len(frames)
@@ -0,0 +1,39 @@
+import pytest
+
+import leds_file
+from analyzer import analyze
+
+PROGRAM = bytes([1, 5, 1, 2, 3, 4, 5, 0, 10]) * 20
+
+
+def chunked_file(tmp_path, contents):
+    path = tmp_path / 'chunked.leds'
+    path.write_bytes(contents)
+    return str(path)
+
+
+def test_header_only_chunked_file_is_rejected(tmp_path):
+    contents = leds_file.pack(PROGRAM, 10, analyze(PROGRAM), chunk_size=64)[:leds_file.HEADER_SIZE]
+    path = chunked_file(tmp_path, contents)
+    with pytest.raises(ValueError, match='Truncated .leds chunk index'):
+        leds_file.ChunkedProgram(path)
+    with pytest.raises(ValueError, match='Truncated .leds chunk index'):
+        leds_file.load(path)
+
+
+@pytest.mark.parametrize('cut', [2, 20, 60])
+def test_truncated_chunked_file_is_rejected(tmp_path, cut):
+    contents = leds_file.pack(PROGRAM, 10, analyze(PROGRAM), chunk_size=64)
+    path = chunked_file(tmp_path, contents[:leds_file.HEADER_SIZE + cut])
+    with pytest.raises(ValueError):
+        program = leds_file.ChunkedProgram(path)
+        program.verify()
+
+
+def test_chunked_file_round_trip(tmp_path):
+    path = chunked_file(tmp_path, leds_file.pack(PROGRAM, 10, analyze(PROGRAM), chunk_size=64))
+    header, data = leds_file.load(path)
+    assert header.chunked and data == PROGRAM
+    program = leds_file.ChunkedProgram(path)
+    program.verify()
+    program.close()
@@ -0,0 +1,43 @@
+from scheduler import DeadlineScheduler
+
+
+class EarlyClock:
+    def __init__(self, early):
+        self.now = 0.0
+        self.early = early
+
+    def time(self):
+        return self.now
+
+    # Wakes up early by a fixed amount, at least a microsecond into the sleep
+    def sleep(self, seconds):
+        self.now += max(seconds - self.early, 1e-6)
+
+
+def test_early_wake_up_is_recorded_as_undershoot():
+    clock = EarlyClock(0.002)
+    scheduler = DeadlineScheduler(clock=clock.time, sleep=clock.sleep, chunk=None)
+    scheduler.advance(0.5)
+    assert scheduler.wait()
+    assert clock.now >= 0.5
+    report = scheduler.report()
+    assert report['sleeps'] == 1
+    assert abs(report['max_undershoot'] - 0.002) < 1e-9
+    assert report['max_overshoot'] == 0.0
+
+
+def test_chunked_sleep_records_the_final_wake_up():
+    clock = EarlyClock(0.001)
+    scheduler = DeadlineScheduler(clock=clock.time, sleep=clock.sleep, chunk=0.1)
+    scheduler.advance(0.35)
+    assert scheduler.wait()
+    assert abs(scheduler.errors[0] + 0.001) < 1e-9
+
+
+def test_late_deadline_is_recorded_as_overshoot():
+    clock = EarlyClock(0.0)
+    scheduler = DeadlineScheduler(clock=clock.time, sleep=clock.sleep)
+    scheduler.advance(0.1)
+    clock.now = 0.15
+    assert scheduler.wait()
+    assert abs(scheduler.report()['max_overshoot'] - 0.05) < 1e-9
@@ -0,0 +1,50 @@
+import zlib
+
+import leds_file
+from analyzer import analyze
+from validator import validate
+
+PROGRAM = bytes([1, 5, 1, 2, 3, 4, 5, 0, 10]) * 20
+
+
+def write(tmp_path, contents):
+    path = tmp_path / 'upload.leds'
+    path.write_bytes(contents)
+    return str(path)
+
+
+def test_valid_programs_are_accepted(tmp_path):
+    for contents in (
+        zlib.compress(PROGRAM),
+        leds_file.pack(PROGRAM, 10, analyze(PROGRAM)),
+        leds_file.pack(PROGRAM, 10, analyze(PROGRAM), chunk_size=64),
+    ):
+        report = validate(write(tmp_path, contents), 10)
+        assert report['ok'], report
+        assert report['played']['reason'] == 'finished'
+
+
+def test_truncated_v1_program_is_reported(tmp_path):
+    report = validate(write(tmp_path, zlib.compress(bytes([6, 1, 3]))), 10)
+    assert not report['ok']
+    assert report['errors'] == ['Invalid program: Truncated operand at offset 1']
+
+
+def test_header_only_chunked_file_is_reported(tmp_path):
+    contents = leds_file.pack(PROGRAM, 10, analyze(PROGRAM), chunk_size=64)[:leds_file.HEADER_SIZE]
+    report = validate(write(tmp_path, contents), 10)
+    assert not report['ok']
+    assert report['errors'] == ['Cannot load the file: Truncated .leds chunk index']
+
+
+def test_out_of_range_pixel_is_reported(tmp_path):
+    report = validate(write(tmp_path, zlib.compress(PROGRAM)), 5)
+    assert report['errors'] == ['Instruction 1 writes pixel 5, the strip has 5 pixels']
+
+
+def test_endless_program_hits_the_instruction_budget(tmp_path):
+    endless = bytes([6, 6, 6, 4, 7, 0xff, 0xff, 7, 0xff, 0xff, 7, 0xff, 0xff])
+    report = validate(write(tmp_path, zlib.compress(endless)), 10, max_instructions=10000)
+    assert report['played']['reason'] == 'instructions'
+    assert report['played']['instructions'] == 10000
+    assert report['errors'] == ['Program executes more than 10000 instructions']
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from color_pipeline import ColorPipeline
+from interpretor import NeoPixelInterpretor
+
+CACHE_DIR = '.frames'
+# Rendered timelines kept on disk, the least recently used ones are removed past this size
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def available():
+    return np is not None
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FrameRecorder:
+    def __init__(self, num_px, clock):
+        self.num_px = num_px
+        self.clock = clock
+        self.buffer = bytearray(num_px * 3)
+        self.frames = []
+        self.timestamps = []
+
+    def __len__(self):
+        return self.num_px
+
+    def __setitem__(self, index, color):
+        if isinstance(index, slice):
+            start = index.start or 0
+            self.buffer[start * 3:start * 3 + len(color) * 3] = bytes(int(c) for px in color for c in px)
+            return
+        self.buffer[index * 3:index * 3 + 3] = bytes(int(c) for c in color)
+
+    def fill(self, color):
+        self.buffer[:] = bytes(int(c) for c in color) * self.num_px
+
+    def show(self):
+        self.frames.append(bytes(self.buffer))
+        self.timestamps.append(self.clock.time())
+
+
+class Timeline:
+    def __init__(self, frames, timestamps, duration):
+        self.frames = frames
+        self.timestamps = timestamps
+        self.duration = duration
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            np.savez_compressed(fd, frames=self.frames, timestamps=self.timestamps, duration=self.duration)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as archive:
+            return cls(archive['frames'], archive['timestamps'], float(archive['duration']))
+
+    def play(self, pixels, should_stop, clock=time.monotonic, sleep=time.sleep, on_frame=None, start=None):
+        if start is None:
+            start = clock()
+        previous = None
+        shown = 0
+        for frame, timestamp in zip(self.frames, self.timestamps):
+            delay = start + timestamp - clock()
+            if delay > 0:
+                sleep(delay)
+            if should_stop():
+                return False, shown
+            # Only the pixels that differ from the previous frame are written to the strip
+            changed = range(len(frame)) if previous is None else np.flatnonzero((frame != previous).any(axis=1))
+            for index in changed:
+                pixels[int(index)] = tuple(frame[index].tolist())
+            pixels.show()
+            if on_frame is not None:
+                on_frame(frame)
+            previous = frame
+            shown += 1
+        delay = start + self.duration - clock()
+        if delay > 0 and not should_stop():
+            sleep(delay)
+        return not should_stop(), shown
+
+
+def render(data, num_px, test=False, test_time=40, runtime=180, pipeline=None):
+    if np is None:
+        raise RuntimeError("Pre-rendered timelines require numpy")
+    clock = VirtualClock()
+    recorder = FrameRecorder(num_px, clock)
+    interpretor = NeoPixelInterpretor(
+        recorder, num_px, test_time=test_time, runtime=runtime, clock=clock.time, sleep=clock.sleep, engine='numpy',
+        pipeline=pipeline
+    )
+    interpretor.run(data, test=test)
+    frames = np.frombuffer(b''.join(recorder.frames), dtype=np.uint8).reshape(len(recorder.frames), num_px, 3)
+    return Timeline(frames, np.array(recorder.timestamps, dtype=np.float64), clock.time())
+
+
+def cache_path(path, data, num_px, test=False, pipeline=None):
+    digest = hashlib.sha1(data)
+    digest.update(b'%d:%d:' % (num_px, test))
+    digest.update((pipeline or ColorPipeline()).signature().encode())
+    directory, name = os.path.split(path)
+    return os.path.join(directory, CACHE_DIR, f'{name}-{digest.hexdigest()[:16]}.npz')
+
+
+def load_or_render(path, data, num_px, test=False, pipeline=None):
+    timeline_path = cache_path(path, data, num_px, test, pipeline)
+    if os.path.isfile(timeline_path):
+        try:
+            timeline = Timeline.load(timeline_path)
+            # Marks it as recently used for prune_cache
+            os.utime(timeline_path)
+            return timeline
+        except (OSError, ValueError, KeyError):
+            _remove(timeline_path)
+    timeline = render(data, num_px, test=test, pipeline=pipeline)
+    timeline.save(timeline_path)
+    prune_cache(os.path.dirname(path))
+    return timeline
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _cached_files(directory):
+    cache_dir = os.path.join(directory, CACHE_DIR)
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(cache_dir, name) for name in names if name.endswith('.npz')]
+
+
+# Name of the animation file a cached timeline was rendered from, see cache_path
+def _animation_name(cached):
+    return os.path.basename(cached).rsplit('-', 1)[0]
+
+
+# Removes the timelines rendered from the animation at path, for every strip size and color pipeline
+def remove_cached(path):
+    directory, name = os.path.split(path)
+    for cached in _cached_files(directory):
+        if _animation_name(cached) == name:
+            _remove(cached)
+
+
+# Removes the cached timelines of the animations of directory that are not in names (all of them are kept
+# with names None), then the least recently used ones until the cache fits in max_bytes. Timelines of an
+# old color pipeline are never used again and end up removed this way
+def prune_cache(directory, names=None, max_bytes=CACHE_MAX_BYTES):
+    entries = []
+    for cached in _cached_files(directory):
+        if names is not None and _animation_name(cached) not in names:
+            _remove(cached)
+            continue
+        try:
+            stat = os.stat(cached)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, cached))
+    total = sum(size for _, size, _ in entries)
+    for _, size, cached in sorted(entries):
+        if total <= max_bytes:
+            break
+        _remove(cached)
+        total -= size
@@ -0,0 +1,208 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import leds_file
+from analyzer import analyze_table
+from decoder import OP_SET, OP_SET_MULTIPLE, OP_SET_BRIGHTNESS, OP_MOVE_UP, OP_MOVE_DOWN
+from interpretor import NeoPixelInterpretor
+from outputs import NullOutput
+from timeline import VirtualClock
+
+# Budget of a validation run: program seconds on the virtual clock (longer programs are cut like the server
+# cuts them), then instructions executed and wall seconds spent (more is rejected)
+MAX_RUNTIME = 180.0
+MAX_INSTRUCTIONS = 1000000
+MAX_SECONDS = 20.0
+# Wall time the HTTP thread waits for a report
+TIMEOUT = 60.0
+
+
+# Report of a validation, also used for uploads rejected before they get to one
+def new_report(**fields):
+    report = {'ok': False, 'errors': [], 'warnings': []}
+    report.update(fields)
+    return report
+
+
+# Rows writing past the end of the strip, as (row, index) of the first one and the highest index written
+def _check_bounds(table, num_px):
+    ops, arg_a, arg_b = table.ops, table.a, table.b
+    highest = -1
+    first = None
+    for row in range(len(ops)):
+        op = ops[row]
+        if op == OP_SET or op == OP_SET_BRIGHTNESS:
+            index = arg_a[row]
+        elif op == OP_MOVE_UP or op == OP_MOVE_DOWN:
+            index = max(arg_a[row], arg_b[row])
+        elif op == OP_SET_MULTIPLE:
+            offset, count = arg_a[row], arg_b[row]
+            index = max(table.multi_index[offset:offset + count], default=-1)
+        else:
+            continue
+        if index > highest:
+            highest = index
+        if index >= num_px and first is None:
+            first = (row, index)
+    return first, highest
+
+
+# Checks a .leds file compiled for num_px pixels (v2 files carry their own) without any hardware: the
+# file must load and decode to at most max_length bytes, a chunk at a time for a chunked file, write only
+# inside the strip and play to its end on a virtual clock within the instruction budget. Runs in a worker
+# process, every failure ends up in the returned report
+def validate(path, num_px=None, max_length=None, max_runtime=MAX_RUNTIME, max_instructions=MAX_INSTRUCTIONS,
+             max_seconds=MAX_SECONDS):
+    start = time.perf_counter()
+    report = new_report()
+    _validate(report, path, num_px, max_length, max_runtime, max_instructions, max_seconds)
+    report['ok'] = not report['errors']
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+
+def _validate(report, path, num_px, max_length, max_runtime, max_instructions, max_seconds):
+    data = program = None
+    try:
+        header = leds_file.read_header(path)
+        if header is not None and header.chunked:
+            # Played like the server plays it, only one chunk is ever decoded
+            program = leds_file.ChunkedProgram(path, max_chunk=max_length)
+        else:
+            header, data = leds_file.load(path, max_length)
+    except Exception as e:
+        report['errors'].append('Cannot load the file: %s' % e)
+        return
+    if header is not None:
+        num_px = header.num_px
+    report.update(
+        version=1 if header is None else header.version, num_px=num_px,
+        bytes=len(data) if program is None else header.length
+    )
+    try:
+        _play(report, header, data, program, num_px, max_runtime, max_instructions, max_seconds)
+    finally:
+        if program is not None:
+            program.close()
+
+
+# Checks the bounds of a table, and of every table following it as the interpreter moves to it
+def _checked(table, num_px, report):
+    if table is None:
+        return None
+    first, highest = _check_bounds(table, num_px)
+    report['max_index'] = max(report.get('max_index', -1), highest)
+    if first is not None:
+        raise ValueError('Instruction %d writes pixel %d, the strip has %d pixels' % (first[0], first[1], num_px))
+    following = table.following
+    if following is not None:
+        table.following = lambda: _checked(following(), num_px, report)
+    return table
+
+
+def _play(report, header, data, program, num_px, max_runtime, max_instructions, max_seconds):
+    errors, warnings = report['errors'], report['warnings']
+    deadline = time.perf_counter() + max_seconds
+    clock = VirtualClock()
+    interpretor = NeoPixelInterpretor(
+        NullOutput(num_px), num_px, runtime=max_runtime, clock=clock.time, sleep=clock.sleep,
+        interrupted=lambda: time.perf_counter() > deadline, max_instructions=max_instructions
+    )
+    try:
+        table = interpretor.build_cmd_q(data) if program is None else program.open_table()
+    except Exception as e:
+        errors.append('Invalid program: %s' % e)
+        return
+
+    try:
+        table = _checked(table, num_px, report)
+    except ValueError as e:
+        errors.append(str(e))
+        return
+
+    try:
+        # A chunked program is not analyzed whole, its header is checked against the playback instead
+        analysis = analyze_table(table) if program is None else header.analysis()
+        progress = interpretor.run_table(table)
+    except Exception as e:
+        errors.append('Program fails after %.3f s: %s: %s' % (clock.time(), type(e).__name__, e))
+        return
+    report.update(analysis.to_dict())
+    report['played'] = {
+        'reason': progress['reason'],
+        'position': progress['position'],
+        'instructions': progress['done'],
+        'frames': interpretor.state.shows,
+    }
+    if progress['reason'] == 'instructions':
+        errors.append('Program executes more than %d instructions' % max_instructions)
+    elif progress['reason'] == 'stopped':
+        errors.append('Program takes more than %.0f s to validate' % max_seconds)
+    elif progress['reason'] == 'runtime':
+        warnings.append('Program is cut after %.0f s' % max_runtime)
+    duration = analysis.duration if program is None else progress['position']
+    if header is not None and (program is None or progress['reason'] == 'finished') and \
+            abs(header.duration - duration) > 0.001:
+        warnings.append('Header duration %.3f s does not match the program (%.3f s)' % (header.duration, duration))
+    if analysis.duration == 0:
+        warnings.append('Program time is zero')
+
+
+# Validates uploads on a bounded pool of worker processes, so a malformed or endless program never runs
+# in the server process. At most queued validations wait for a worker, more are rejected right away
+class ValidatorPool:
+    def __init__(self, workers=2, queued=4, timeout=TIMEOUT, max_length=None):
+        self.workers = workers
+        self.max_length = max_length
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers + queued)
+        self.sem = threading.Semaphore()
+        self.pool = None
+
+    def _pool(self):
+        self.sem.acquire()
+        if self.pool is None:
+            # The server runs threads by the time of the first upload, and forking them can deadlock the child
+            # on a lock another thread held. The fork server starts clean and imports the server module once,
+            # whose setup only runs as __main__
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver')
+            )
+        pool = self.pool
+        self.sem.release()
+        return pool
+
+    def _reset(self, pool):
+        self.sem.acquire()
+        if self.pool is pool:
+            self.pool = None
+        self.sem.release()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    # Blocks the calling thread until the report is ready
+    def validate(self, path, num_px=None):
+        if not self.slots.acquire(blocking=False):
+            return new_report(errors=['Too many uploads are being validated, try again later'])
+        pool = self._pool()
+        try:
+            future = pool.submit(validate, path, num_px, self.max_length)
+        except BrokenProcessPool:
+            self.slots.release()
+            self._reset(pool)
+            return new_report(errors=['Validation worker crashed'])
+        # The slot stays taken until the worker is done, also after a timeout
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            return new_report(errors=['Validation took longer than %.0f s' % self.timeout])
+        except BrokenProcessPool:
+            self._reset(pool)
+            return new_report(errors=['Validation worker crashed'])
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)